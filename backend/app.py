@@ -1,29 +1,30 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import joblib
-import pandas as pd
-import numpy as np
 import os
 import sys
-import traceback
+from log_config import get_logger
 
 # --- Import service and DB functions ---
-from diet_planner_service import AdaptiveDietPlanner
+from diet_planner_service import AdaptiveDietPlanner, DAYS, MEAL_TYPES
 from relief_recommender_service import ReliefRecommender
+from stage_predictor_service import StageInference, REQUIRED_FIELDS
+from model_registry import registry, resolve_model_path
 from database import (
     init_db, 
     register_user,
     login_user,
     insert_user_data, 
-    get_latest_user_record,
     insert_symptom_log,
     get_user_profile,
     insert_user_profile,
+    register_profile_listener,
     insert_remedy_recommendation,
     update_remedy_feedback,
-    get_db_connection
+    get_remedy_summary
 )
 
+logger = get_logger("app")
+
 app = Flask(__name__)
 # Enable global CORS with support for credentials and all origins
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
@@ -35,69 +36,62 @@ PROJECT_ROOT = os.path.dirname(BASE_DIR)
 # ---------- PATH CONFIG (Restructured Paths) ----------
 # Note: PROJECT_ROOT is now one level up from backend/
 recipe_path = os.path.join(PROJECT_ROOT, "datasets_sample", "DIET_DATA_PROCESSED", "cleaned_indian_recipes_for_ml.csv")
-symptom_model_path = os.path.join(PROJECT_ROOT, "ml_models", "symptom_prediction_model_final.pkl")
-symptom_features_path = os.path.join(PROJECT_ROOT, "ml_models", "final_feature_names.pkl")
-diet_model_path = os.path.join(PROJECT_ROOT, "ml_models", "diet_suitability_predictor.pkl")
-diet_features_path = os.path.join(PROJECT_ROOT, "ml_models", "diet_predictor_features.pkl")
-stage_model_path = os.path.join(PROJECT_ROOT, "ml_models", "stage_prediction_model.pkl")
-stage_features_path = os.path.join(PROJECT_ROOT, "ml_models", "stage_predictor_features.pkl")
+symptom_model_path = resolve_model_path("symptom_prediction_model_final.pkl")
+symptom_features_path = resolve_model_path("final_feature_names.pkl")
+diet_model_path = resolve_model_path("diet_suitability_predictor.pkl")
+diet_features_path = resolve_model_path("diet_predictor_features.pkl")
+stage_model_path = resolve_model_path("stage_prediction_model.pkl")
+stage_features_path = resolve_model_path("stage_predictor_features.pkl")
+
+# Set MENOMAP_DETERMINISTIC_PLANS=1 to serve the same cached week plan for identical requests
+DETERMINISTIC_PLANS = os.environ.get("MENOMAP_DETERMINISTIC_PLANS", "0") == "1"
 
 # Initialize local sqlite database automatically
-print("⏳ Initializing database...")
+logger.info("⏳ Initializing database...")
 init_db()
-print("✅ Database initialized successfully.")
+logger.info("✅ Database initialized successfully.")
 
 # ---------- INITIALIZE ML MODELS ----------
-try:
+# Each service is registered with the shared model registry and built by its factory.
+# By default every model is loaded here, before the app serves anything. With
+# MENOMAP_LAZY_MODELS=1 nothing is loaded at import: models are warmed on a background
+# thread (unless MENOMAP_WARM_MODELS=0) and any request that needs one first waits for it.
+LAZY_MODELS = os.environ.get("MENOMAP_LAZY_MODELS", "0") == "1"
+WARM_MODELS = os.environ.get("MENOMAP_WARM_MODELS", "1") == "1"
+
+def _load_planner():
     planner = AdaptiveDietPlanner(
         recipe_path=recipe_path,
         symptom_model_path=symptom_model_path,
         symptom_features_path=symptom_features_path,
         diet_model_path=diet_model_path,
         diet_features_path=diet_features_path,
+        deterministic_plans=DETERMINISTIC_PLANS,
     )
-    print("✅ AdaptiveDietPlanner initialized successfully!")
-except Exception as e:
-    print(f"❌ Failed to initialize AdaptiveDietPlanner: {e}")
-    planner = None
-
-try:
-    stage_model = joblib.load(stage_model_path)
-    stage_model_features = joblib.load(stage_features_path)
-    print("✅ Stage Predictor Model loaded successfully!")
-except Exception as e:
-    print(f"❌ Failed to initialize Stage Predictor: {e}")
-    stage_model = None
-
-try:
-    recommender = ReliefRecommender()
-    print("✅ ReliefRecommender initialized successfully!")
-except Exception as e:
-    print(f"❌ Failed to initialize ReliefRecommender: {e}")
-    recommender = None
+    logger.info("✅ AdaptiveDietPlanner initialized successfully!")
+    return planner
 
+def _load_stage_predictor():
+    stage_predictor = StageInference(stage_model_path, stage_features_path)
+    logger.info("✅ Stage Predictor Model loaded successfully!")
+    return stage_predictor
 
-# ---------- STAGE PREDICTOR HELPER FUNCTIONS ----------
+def _load_recommender():
+    recommender = ReliefRecommender()
+    # A rewritten profile makes that user's cached remedy rankings stale
+    register_profile_listener(recommender.invalidate_user)
+    logger.info("✅ ReliefRecommender initialized successfully!")
+    return recommender
 
-def convert_slider_to_ternary(value):
-    """Converts a 0-10 slider value to a 0-2 ternary scale."""
-    try:
-        val = int(value)
-        if val <= 3:  return 0  # Mild
-        elif val <= 7: return 1  # Moderate
-        else:          return 2  # Severe
-    except (ValueError, TypeError):
-        return 0 # Default to 0 if data is bad
-
-def map_stage_to_string(stage_code):
-    """Converts the model's number output to a user-friendly string."""
-    stage_map = {
-        0: "Premenopause",
-        1: "Perimenopause",
-        2: "Menopause",
-        3: "Postmenopause"
-    }
-    return stage_map.get(stage_code, "Unknown")
+registry.register_resource("planner", _load_planner)
+registry.register_resource("stage_predictor", _load_stage_predictor)
+registry.register_resource("relief_recommender", _load_recommender)
+
+if not LAZY_MODELS:
+    registry.warm()
+elif WARM_MODELS:
+    logger.info("⏳ Lazy model loading: warming models in the background...")
+    registry.warm_in_background()
 
 
 # ---------- ROUTES ----------
@@ -112,6 +106,29 @@ def home():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.route("/ready", methods=["GET", "OPTIONS"])
+def ready():
+    """
+    Readiness probe: 503 while models are still loading. Then "degraded" if a model failed,
+    "lazy" if some are not loaded yet (lazy mode without warm-up: they load on first use),
+    otherwise "ready"; each with the per-model states.
+    """
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
+    status = registry.resource_status()
+    if not registry.is_ready():
+        return jsonify({"status": "loading", **status}), 503
+    states = [model["state"] for model in status["models"].values()]
+    if "failed" in states:
+        overall = "degraded"
+    elif "not_loaded" in states:
+        overall = "lazy"
+    else:
+        overall = "ready"
+    return jsonify({"status": overall, "lazy_models": LAZY_MODELS, **status})
+
+
 @app.route("/register", methods=["POST", "OPTIONS"])
 def register():
     if request.method == "OPTIONS":
@@ -119,7 +136,8 @@ def register():
     
     try:
         data = request.get_json(force=True)
-        print("REGISTER PAYLOAD:", data, flush=True)
+        # Never log the payload itself: it contains the password
+        logger.debug("Received /register for %s", data.get('email'))
         email = data.get('email')
         password = data.get('password')
         name = data.get('name', 'User')
@@ -135,8 +153,7 @@ def register():
         else:
             return jsonify({"status": "error", "message": "Email already in use or registration failed"}), 400
     except Exception as e:
-        print(f"❌ Exception in /register: {e}")
-        traceback.print_exc()
+        logger.exception("❌ Exception in /register: %s", e)
         return jsonify({"status": "error", "message": f"Server processing error: {str(e)}"}), 500
 
 
@@ -163,7 +180,7 @@ def login():
         else:
             return jsonify({"status": "error", "message": "Invalid email or password"}), 401
     except Exception as e:
-        print(f"❌ Exception in /login: {e}")
+        logger.exception("❌ Exception in /login: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
@@ -202,7 +219,7 @@ def update_profile():
         insert_user_profile(user_id, profile_data)
         return jsonify({"status": "success", "message": "Profile updated successfully"})
     except Exception as e:
-        print(f"❌ Exception in /update_profile: {e}")
+        logger.exception("❌ Exception in /update_profile: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
@@ -212,11 +229,12 @@ def recommend_diet():
         return jsonify({"status": "ok"}), 200
         
     try:
+        planner = registry.resource("planner")
         if planner is None:
             return jsonify({"status": "error", "message": "Planner not initialized properly."}), 500
 
         data = request.get_json(force=True)
-        print("\n🟢 Received /recommend data:", data, flush=True)
+        logger.debug("🟢 Received /recommend data: %s", data)
 
         user_id = data.get("user_id", "guest")
         age = data.get("age")
@@ -227,16 +245,80 @@ def recommend_diet():
         preferences = json.dumps(data.get("preferences", []))
         extra_json = json.dumps(data.get("extra", {})) if data.get("extra") else None
 
-        insert_user_data(user_id=user_id, age=age, symptoms=symptoms, preferences=preferences, mood=mood, extra_json=extra_json)
-        
-        user_row = get_latest_user_record(user_id)
-        result = planner.get_diet_recommendation(request_data=data, user_row=user_row)
+        # Write-behind: the plan is built from the request itself, so don't wait for the commit
+        insert_user_data(user_id=user_id, age=age, symptoms=symptoms, preferences=preferences,
+                         mood=mood, extra_json=extra_json, wait=False)
+        result = planner.get_diet_recommendation(request_data=data)
         
-        print("✅ Diet recommendation generated.")
+        logger.debug("✅ Diet recommendation generated.")
+        return jsonify({"status": "success", "data": result})
+    except Exception as e:
+        logger.exception("❌ Exception in /recommend: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+MAX_BATCH_REQUESTS = 1000  # Users per /recommend/batch call; larger jobs are split by the caller
+
+
+@app.route("/recommend/batch", methods=["POST", "OPTIONS"])
+def recommend_diet_batch():
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
+    try:
+        planner = registry.resource("planner")
+        if planner is None:
+            return jsonify({"status": "error", "message": "Planner not initialized properly."}), 500
+
+        data = request.get_json(force=True)
+        requests_list = data.get("requests") if isinstance(data, dict) else None
+        if not isinstance(requests_list, list) or not requests_list:
+            return jsonify({"status": "error", "message": "'requests' must be a non-empty list"}), 400
+        if len(requests_list) > MAX_BATCH_REQUESTS:
+            return jsonify({"status": "error",
+                            "message": f"At most {MAX_BATCH_REQUESTS} requests per batch"}), 400
+
+        results = planner.get_diet_recommendations_batch(requests_list)
+
+        logger.info("✅ Batch diet recommendations generated for %d users.", len(results))
+        return jsonify({"status": "success", "data": {"results": results}})
+    except Exception as e:
+        logger.exception("❌ Exception in /recommend/batch: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route("/recommend/swap", methods=["POST", "OPTIONS"])
+def swap_meal():
+    if request.method == "OPTIONS":
+        return jsonify({"status": "ok"}), 200
+
+    try:
+        planner = registry.resource("planner")
+        if planner is None:
+            return jsonify({"status": "error", "message": "Planner not initialized properly."}), 500
+
+        data = request.get_json(force=True)
+        plan_id = data.get("plan_id")
+        day = data.get("day")
+        meal_type = data.get("meal_type")
+        # The original /recommend payload and the current week_plan let any worker
+        # rebuild the plan when its swap session lives in another process
+        original_request = data.get("request")
+        week_plan = data.get("week_plan")
+        if not (day and meal_type and (plan_id or (original_request and week_plan))):
+            return jsonify({"status": "error",
+                            "message": "day, meal_type and either plan_id or request + week_plan are required"}), 400
+        if day not in DAYS or meal_type not in MEAL_TYPES:
+            return jsonify({"status": "error", "message": f"Unknown slot: {day} / {meal_type}."}), 400
+
+        result = planner.swap_meal(plan_id, day, meal_type, request_data=original_request, week_plan=week_plan)
+        if "error" in result:
+            status_code = 404 if result.get("error_type") == "not_found" else 400
+            return jsonify({"status": "error", "message": result["error"]}), status_code
+
         return jsonify({"status": "success", "data": result})
     except Exception as e:
-        print(f"❌ Exception in /recommend: {e}")
-        traceback.print_exc()
+        logger.exception("❌ Exception in /recommend/swap: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
@@ -247,70 +329,41 @@ def predict_stage():
         return jsonify({"status": "ok"}), 200
         
     try:
-        if not stage_model:
+        stage_predictor = registry.resource("stage_predictor")
+        if not stage_predictor:
             return jsonify({"status": "error", "message": "Stage Predictor Model is not loaded."}), 500
 
         data = request.get_json(force=True)
         if not data:
             return jsonify({"status": "error", "message": "No input data provided."}), 400
 
-        required_fields = ['hot_flashes', 'mood_swings', 'fatigue', 'sleep_issues', 'brain_fog']
-        if not all(field in data for field in required_fields):
-            return jsonify({"status": "error", "message": f"Missing required symptom data. Required: {required_fields}"}), 400
-            
-        print("\n🟢 Received /predict-stage data:", data, flush=True)
-
-        # Prepare Data for the Model
-        input_data = {feature: 0 for feature in stage_model_features}
-        symptom_mapping = {
-            'hot_flashes': 'hot_flashes_severity_ternary',
-            'night_sweats': 'night_sweats_severity_ternary',
-            'mood_swings': 'mood_swings_severity_ternary',
-            'sleep_issues': 'sleep_disturbances_severity_ternary',
-            'fatigue': 'fatigue_severity_meno_ternary', 
-            'brain_fog': 'brain_fog_severity_ternary',
-            'irritability': 'mood_swings_irritability_severity_ternary',
-        }
-        for app_key, model_key in symptom_mapping.items():
-            if app_key in data:
-                input_data[model_key] = convert_slider_to_ternary(data[app_key])
-        
-        if 'fatigue' in data:
-            val = convert_slider_to_ternary(data['fatigue'])
-            input_data['fatigue_severity_meno_ternary'] = val
-            input_data['fatigue_severity_pcos_ternary'] = val
+        if not all(field in data for field in REQUIRED_FIELDS):
+            return jsonify({"status": "error", "message": f"Missing required symptom data. Required: {REQUIRED_FIELDS}"}), 400
             
-        if 'mood_swings' in data:
-            val = convert_slider_to_ternary(data['mood_swings'])
-            input_data['mood_swings_severity_ternary'] = val
-            input_data['mood_swings_irritability_severity_ternary'] = val
-
-        df_input = pd.DataFrame([input_data])[stage_model_features]
+        logger.debug("🟢 Received /predict-stage data: %s", data)
 
-        # Make prediction
-        prediction_code = stage_model.predict(df_input)[0]
-        prediction_proba = stage_model.predict_proba(df_input)
-        confidence = np.max(prediction_proba) * 100
-        predicted_stage_string = map_stage_to_string(prediction_code)
+        # One predict_proba pass gives the stage, its confidence and the full distribution
+        prediction = stage_predictor.predict(data)
+        predicted_stage_string = prediction["predicted_stage"]
 
         # Save the log to the database
         user_id = data.get("user_id", "guest")
         log_date = data.get("log_date", "default_date_string")
         
-        new_log_id = insert_symptom_log(user_id, log_date, predicted_stage_string, data)
-        print(f"✅ Stage log saved with ID: {new_log_id}")
+        new_log_id = insert_symptom_log(user_id, log_date, predicted_stage_string, data)['log_id']
+        logger.debug("✅ Stage log saved with ID: %s", new_log_id)
 
         return jsonify({
             "status": "success",
             "data": {
                 "predicted_stage": predicted_stage_string,
-                "confidence": round(confidence, 2),
+                "confidence": prediction["confidence"],
+                "probabilities": prediction["probabilities"],
                 "log_id": new_log_id
             }
         })
     except Exception as e:
-        print(f"❌ Exception in /predict-stage: {e}")
-        traceback.print_exc()
+        logger.exception("❌ Exception in /predict-stage: %s", e)
         return jsonify({"status": "error", "message": f"Prediction failed: {str(e)}"}), 500
 
 
@@ -326,7 +379,7 @@ def log_symptoms():
         if not all([user_id, log_date, symptoms]):
             return jsonify({"status": "error", "message": "Missing user_id, log_date, or symptoms"}), 400
         
-        log_id = insert_symptom_log(user_id, log_date, "Logged", symptoms)
+        log_id = insert_symptom_log(user_id, log_date, "Logged", symptoms)['log_id']
         return jsonify({"status": "success", "message": "Symptoms logged successfully", "data": {"log_id": log_id}})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -339,18 +392,23 @@ def get_remedy():
         return jsonify({"status": "ok"}), 200
         
     try:
+        recommender = registry.resource("relief_recommender")
         if not recommender:
             return jsonify({"status": "error", "message": "Relief Recommender not initialized."}), 500
 
         data = request.get_json(force=True)
-        print("\n🟢 Received /predict-relief data:", data, flush=True)
+        logger.debug("🟢 Received /predict-relief data: %s", data)
 
         user_id = data.get('user_id')
         log_id = data.get('log_id')
         target_symptom_key = data.get('target_symptom_key')
         current_severity_ternary = data.get('current_severity_ternary')
+        # mode "all": rank every remedy for every symptom from one set of model calls
+        rank_all = data.get('mode') == 'all' or target_symptom_key == 'all'
 
-        if not all([user_id, log_id, target_symptom_key, current_severity_ternary is not None]):
+        if not rank_all and not all([user_id, log_id, target_symptom_key, current_severity_ternary is not None]):
+            return jsonify({"status": "error", "message": "Missing required fields"}), 400
+        if rank_all and not all([user_id, log_id]):
             return jsonify({"status": "error", "message": "Missing required fields"}), 400
 
         # Fetch User's Base Profile
@@ -366,7 +424,23 @@ def get_remedy():
             }
             insert_user_profile(user_id, profile_data)
 
-        recommendation = recommender.recommend_relief(profile_data, target_symptom_key, current_severity_ternary)
+        if rank_all:
+            ranking = recommender.recommend_relief_all(profile_data, user_id=user_id)
+            if "error" in ranking:
+                return jsonify({"status": "error", "message": ranking["error"]}), 500
+
+            # One history row per call, like the single-symptom mode: the best overall remedy,
+            # logged against target_symptom "all", receives the feedback
+            ranking['history_id'] = insert_remedy_recommendation(
+                log_id=log_id, user_id=user_id, target_symptom='all',
+                remedy_recommended=ranking['best_overall']['best_remedy_id']
+            )['history_id']
+
+            logger.debug("✅ Full relief ranking returned for %d symptoms", len(ranking['best_per_symptom']))
+            return jsonify({"status": "success", "data": ranking})
+
+        recommendation = recommender.recommend_relief(profile_data, target_symptom_key, current_severity_ternary,
+                                                      user_id=user_id)
         
         if "error" in recommendation:
             return jsonify({"status": "error", "message": recommendation["error"]}), 500
@@ -375,13 +449,13 @@ def get_remedy():
         history_id = insert_remedy_recommendation(
             log_id=log_id, user_id=user_id, target_symptom=target_symptom_key,
             remedy_recommended=recommendation['best_remedy_id']
-        )
+        )['history_id']
         recommendation['history_id'] = history_id
         
-        print(f"✅ Recommendation returned: {recommendation['best_remedy_id']}")
+        logger.debug("✅ Recommendation returned: %s", recommendation['best_remedy_id'])
         return jsonify({"status": "success", "data": recommendation})
     except Exception as e:
-        print(f"❌ Exception in /predict-relief: {e}")
+        logger.exception("❌ Exception in /predict-relief: %s", e)
         return jsonify({"status": "error", "message": f"Recommendation failed: {str(e)}"}), 500
 
 
@@ -401,10 +475,10 @@ def log_feedback():
         effectiveness_score = 1 if was_effective else 0
         update_remedy_feedback(history_id, effectiveness_score)
         
-        print(f"✅ Feedback saved for history_id: {history_id}")
+        logger.debug("✅ Feedback saved for history_id: %s", history_id)
         return jsonify({"status": "success", "message": "Feedback saved!"})
     except Exception as e:
-        print(f"❌ Exception in /log_remedy_feedback: {e}")
+        logger.exception("❌ Exception in /log_remedy_feedback: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
@@ -419,15 +493,7 @@ def get_relief_summary():
         if not user_id:
             return jsonify({"status": "error", "message": "user_id is required"}), 400
 
-        conn = get_db_connection()
-        rows = conn.cursor().execute(
-            """
-            SELECT remedy_recommended, AVG(effectiveness) * 100 as effectiveness_percent, COUNT(*) as log_count
-            FROM remedy_history WHERE user_id = ? AND effectiveness != -1
-            GROUP BY remedy_recommended ORDER BY effectiveness_percent DESC
-            """, (user_id,)
-        ).fetchall()
-        conn.close()
+        rows = get_remedy_summary(user_id)
 
         summary_data = []
         emoji_map = {
@@ -448,12 +514,12 @@ def get_relief_summary():
 
         return jsonify({"status": "success", "data": {"summary": summary_data, "trend": mock_trend, "aiSuggestion": ai_suggestion}})
     except Exception as e:
-        print(f"❌ Exception in /get_relief_summary: {e}")
+        logger.exception("❌ Exception in /get_relief_summary: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
 # ---------- RUN ----------
 if __name__ == "__main__":
-    print("\n🚀 MENOMAP Backend starting...")
-    print("MENOMAP Backend running at http://localhost:5002")
+    logger.info("🚀 MENOMAP Backend starting...")
+    logger.info("MENOMAP Backend running at http://localhost:5002")
     app.run(host="0.0.0.0", port=5002, debug=False)
\ No newline at end of file
@@ -1,17 +1,172 @@
 import sqlite3
 from sqlite3 import Connection
-from typing import Optional, Dict, Any
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, Union
 
 import os
+import queue
+import threading
+
+from write_behind import WriteBehindWriter, WRITE_TIMEOUT_SECONDS
+from log_config import get_logger
+
+logger = get_logger("database")
 
 # Get the directory where database.py is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE = os.path.join(BASE_DIR, "menomap.db")
 
+# --- Connection Pool ---
+# Idle connections kept per database file (more are opened under load, then closed)
+DB_POOL_SIZE = int(os.environ.get("MENOMAP_DB_POOL_SIZE", "8"))
+# Applied once when a connection is opened. WAL lets readers run alongside the writer,
+# and with synchronous=NORMAL a commit no longer waits for an fsync of the whole journal.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MB of the file memory-mapped for reads
+    "PRAGMA cache_size=-16000",    # 16 MB page cache per connection
+    "PRAGMA busy_timeout=5000",    # wait for a competing writer instead of failing
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """A sqlite3 connection whose close() hands it back to its pool instead of closing it."""
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def close_for_real(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of open connections to one database file.
+    acquire() reuses an idle connection (or opens a new one); close() on the
+    connection returns it. Up to `size` idle connections are kept.
+    """
+    def __init__(self, db_file, size=DB_POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue()  # Most recently used first: its pages are warm
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        return conn
+
+    def acquire(self) -> Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()  # Never hand out a connection with uncommitted work
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close_for_real()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close_for_real()
+            except queue.Empty:
+                return
+
+
+_pools = {}  # db file -> ConnectionPool
+_pools_lock = threading.Lock()
+
+def _get_pool(db_file) -> ConnectionPool:
+    pool = _pools.get(db_file)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(db_file, ConnectionPool(db_file))
+    return pool
+
+# --- Write-Behind Writer (append-only log tables) ---
+# One writer thread per database file, started on first use. With gunicorn --preload
+# nothing is written in the master, so every worker starts its own writer after fork.
+_writers = {}  # db file -> WriteBehindWriter
+_writers_lock = threading.Lock()
+
+def _get_writer(db_file) -> WriteBehindWriter:
+    writer = _writers.get(db_file)
+    if writer is None or not writer.is_alive():
+        with _writers_lock:
+            writer = _writers.get(db_file)
+            if writer is None or not writer.is_alive():  # Replace a writer whose thread died
+                writer = _writers[db_file] = WriteBehindWriter(_get_pool(db_file).acquire)
+    return writer
+
+def _insert_record(table, id_column, record, wait):
+    """
+    Queues an INSERT of `record` (column -> value) into `table` and returns the record
+    with its generated `id_column` filled in, so callers never read the row back.
+    With wait=False it returns a Future of that record instead of waiting for the group commit.
+    """
+    columns = list(record)
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    future = _get_writer(DB_FILE).submit(sql, [record[col] for col in columns])
+
+    def _with_id(row_id):
+        return {id_column: row_id, **record}
+
+    if wait:
+        return _with_id(future.result(WRITE_TIMEOUT_SECONDS))
+    inserted = Future()
+    def _resolve(done):
+        if done.exception() is not None:
+            # The caller may never look at this Future, so the failure is logged here too
+            logger.error("❌ Write-behind insert into %s failed: %s", table, done.exception())
+            inserted.set_exception(done.exception())
+        else:
+            inserted.set_result(_with_id(done.result()))
+    future.add_done_callback(_resolve)
+    return inserted
+
+def _utc_timestamp() -> str:
+    """Now in SQLite's CURRENT_TIMESTAMP format (UTC, 'YYYY-MM-DD HH:MM:SS')."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def flush_writes():
+    """Blocks until every queued log write has been committed."""
+    for writer in list(_writers.values()):
+        writer.flush()
+
+def _forget_pools():
+    # SQLite connections and threads do not survive fork(); each worker opens its own
+    global _pools, _pools_lock, _writers, _writers_lock
+    _pools, _pools_lock = {}, threading.Lock()
+    _writers, _writers_lock = {}, threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_pools)
+
+# Callbacks run with the user_id after insert_user_profile() commits (e.g. cache invalidation)
+_profile_listeners = []
+
+def register_profile_listener(callback):
+    """Registers callback(user_id), called every time a user's profile is written."""
+    _profile_listeners.append(callback)
+    return callback
+
 def get_db_connection() -> Connection:
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Borrows a pooled connection; conn.close() returns it to the pool."""
+    return _get_pool(DB_FILE).acquire()
 
 def init_db():
     conn = get_db_connection()
@@ -97,58 +252,137 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON symptom_logs(user_id)')
     
     conn.commit()
+    migrate_db(conn)
     conn.close()
 
+# --- Schema Migrations ---
+# (version, description, statements). Applied in order by migrate_db(); PRAGMA user_version
+# records the last one applied, so each runs exactly once per database file.
+# Never edit a released migration: append a new one.
+SCHEMA_MIGRATIONS = [
+    (1, "composite indexes for the hot per-user queries", [
+        # get_latest_user_record: WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1
+        "CREATE INDEX IF NOT EXISTS idx_user_data_user_timestamp ON user_data(user_id, timestamp)",
+        # get_remedy_summary: WHERE user_id = ? AND effectiveness != -1 GROUP BY remedy_recommended,
+        # answered from the index alone, already grouped
+        "CREATE INDEX IF NOT EXISTS idx_remedy_history_user_remedy "
+        "ON remedy_history(user_id, remedy_recommended, effectiveness)",
+    ]),
+]
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(conn):
+    """
+    Applies every migration newer than the database's user_version, each in its own transaction,
+    and drops the cached table metadata so the next write sees the current schema.
+    Then checks the hot query plans and logs a warning if an index regression makes one scan.
+    """
+    current = schema_version(conn)
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        with conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+        logger.info("🛠️ Applied schema migration %d: %s", version, description)
+    _forget_schema_cache()
+    try:
+        check_query_plans(conn)
+    except (RuntimeError, sqlite3.OperationalError) as e:
+        logger.warning("⚠️ Query plan check failed: %s", e)
+    return schema_version(conn)
+
 # --- Existing Functions for Diet Planner ---
 
 def insert_user_data(user_id: str, age: Optional[int], symptoms: str,
-                     preferences: str, mood: Optional[str], extra_json: Optional[str] = None):
-    conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO user_data (user_id, age, symptoms, preferences, mood, extra_json) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, age, symptoms, preferences, mood, extra_json),
-    )
-    conn.commit()
-    conn.close()
+                     preferences: str, mood: Optional[str], extra_json: Optional[str] = None,
+                     wait: bool = True) -> Union[Dict[str, Any], Future]:
+    """
+    Inserts a diet-planner request and returns the stored row as a dict
+    (id, user_id, age, symptoms, preferences, mood, extra_json, timestamp).
+    With wait=False it returns a Future of that dict instead of waiting for the group commit.
+    """
+    return _insert_record("user_data", "id", {
+        "user_id": user_id, "age": age, "symptoms": symptoms, "preferences": preferences,
+        "mood": mood, "extra_json": extra_json, "timestamp": _utc_timestamp(),
+    }, wait)
+
+LATEST_USER_RECORD_SQL = "SELECT * FROM user_data WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1"
 
 def get_latest_user_record(user_id: str):
     conn = get_db_connection()
-    row = conn.execute(
-        "SELECT * FROM user_data WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1",
-        (user_id,),
-    ).fetchone()
+    row = conn.execute(LATEST_USER_RECORD_SQL, (user_id,)).fetchone()
     conn.close()
     return row
 
 # --- NEW Functions for Symptom Tracker & Relief Recommender ---
 
+# user_profile's columns and REPLACE statement, per database file. Built from
+# PRAGMA table_info on first use and dropped by migrate_db(), so a schema change is
+# picked up without a metadata query on every write.
+_profile_statements = {}  # db file -> (profile columns without user_id, REPLACE INTO sql)
+
+def _user_profile_statement(conn):
+    statement = _profile_statements.get(DB_FILE)
+    if statement is None:
+        table_columns = [col['name'] for col in conn.execute("PRAGMA table_info(user_profile)")
+                         if col['name'] != 'user_id']
+        col_names_str = ", ".join(table_columns)
+        placeholders_str = ", ".join(["?"] * len(table_columns))
+        query = f"REPLACE INTO user_profile (user_id, {col_names_str}) VALUES (?, {placeholders_str})"
+        statement = (table_columns, query)
+        if table_columns:  # Table not created yet: don't cache, let the write fail as usual
+            _profile_statements[DB_FILE] = statement
+    return statement
+
+def _forget_schema_cache():
+    _profile_statements.clear()
+
 def insert_user_profile(user_id: str, profile_data: Dict[str, Any]):
     """
-    Inserts or updates a user's base profile.
-    Dynamically builds the query based on existing table columns.
+    Inserts or updates a user's base profile and returns the stored row as a dict.
+    Columns come from the table itself (cached); keys that are not columns are ignored
+    and missing columns are stored as NULL.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 1. Get existing columns in the table
-    cursor.execute("PRAGMA table_info(user_profile)")
-    columns_info = cursor.fetchall()
-    table_columns = [col['name'] for col in columns_info if col['name'] != 'user_id']
-    
-    # 2. Match profile_data keys to table columns
-    # If a key is missing, use None
+    table_columns, query = _user_profile_statement(conn)
     values = [profile_data.get(col) for col in table_columns]
-    
-    # 3. Build dynamic query
-    col_names_str = ", ".join(table_columns)
-    placeholders_str = ", ".join(["?"] * len(table_columns))
-    
-    query = f"REPLACE INTO user_profile (user_id, {col_names_str}) VALUES (?, {placeholders_str})"
-    
-    cursor.execute(query, [user_id] + values)
+    conn.execute(query, [user_id] + values)
     conn.commit()
     conn.close()
 
+    for callback in _profile_listeners:
+        callback(user_id)
+    return {"user_id": user_id, **dict(zip(table_columns, values))}
+
+def insert_user_profiles(profiles) -> int:
+    """
+    Bulk insert_user_profile for imports: `profiles` is a {user_id: profile_data} mapping
+    or an iterable of (user_id, profile_data) pairs. All rows are written in ONE
+    transaction; returns the number of profiles written.
+    """
+    items = profiles.items() if isinstance(profiles, dict) else profiles
+    conn = get_db_connection()
+    try:
+        table_columns, query = _user_profile_statement(conn)
+        user_ids = []
+        def rows():
+            for user_id, profile_data in items:
+                user_ids.append(user_id)
+                yield [user_id] + [profile_data.get(col) for col in table_columns]
+        with conn:
+            conn.executemany(query, rows())
+    finally:
+        conn.close()
+
+    for user_id in user_ids:
+        for callback in _profile_listeners:
+            callback(user_id)
+    return len(user_ids)
+
 def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
     """
     Fetches a user's base profile as a dictionary.
@@ -166,54 +400,32 @@ def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
     return None
 
 def insert_symptom_log(user_id: str, log_date: str, predicted_stage: str, 
-                       symptoms: Dict[str, Any]) -> int:
+                       symptoms: Dict[str, Any], wait: bool = True) -> Union[Dict[str, Any], Future]:
     """
-    Inserts a daily symptom log and returns the new log_id.
+    Inserts a daily symptom log and returns the stored row as a dict, including the new log_id.
     'symptoms' is the raw data from the app (e.g., {'hot_flashes': 7, ...})
+    With wait=False it returns a Future of that dict instead of waiting for the group commit.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT INTO symptom_logs 
-        (user_id, log_date, predicted_stage, hot_flashes, mood_swings, fatigue, sleep_issues, brain_fog, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''',
-        (
-            user_id, log_date, predicted_stage,
-            symptoms.get('hot_flashes', 0),
-            symptoms.get('mood_swings', 0),
-            symptoms.get('fatigue', 0),
-            symptoms.get('sleep_issues', 0),
-            symptoms.get('brain_fog', 0),
-            symptoms.get('notes', '')
-        )
-    )
-    conn.commit()
-    log_id = cursor.lastrowid # Get the ID of the log we just inserted
-    conn.close()
-    return log_id
+    return _insert_record("symptom_logs", "log_id", {
+        "user_id": user_id, "log_date": log_date, "predicted_stage": predicted_stage,
+        "hot_flashes": symptoms.get('hot_flashes', 0),
+        "mood_swings": symptoms.get('mood_swings', 0),
+        "fatigue": symptoms.get('fatigue', 0),
+        "sleep_issues": symptoms.get('sleep_issues', 0),
+        "brain_fog": symptoms.get('brain_fog', 0),
+        "notes": symptoms.get('notes', ''),
+    }, wait)
 
 def insert_remedy_recommendation(log_id: int, user_id: str, target_symptom: str, 
-                                remedy_recommended: str) -> int:
+                                remedy_recommended: str, wait: bool = True) -> Union[Dict[str, Any], Future]:
     """
     Logs that a remedy was recommended (feedback is pending).
-    Returns the new history_id.
+    Returns the stored row as a dict, including the new history_id, or a Future of it with wait=False.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT INTO remedy_history 
-        (log_id, user_id, target_symptom, remedy_recommended, effectiveness) 
-        VALUES (?, ?, ?, ?, -1)
-        ''',
-        (log_id, user_id, target_symptom, remedy_recommended)
-    )
-    conn.commit()
-    history_id = cursor.lastrowid
-    conn.close()
-    return history_id
+    return _insert_record("remedy_history", "history_id", {
+        "log_id": log_id, "user_id": user_id, "target_symptom": target_symptom,
+        "remedy_recommended": remedy_recommended, "effectiveness": -1, "timestamp": _utc_timestamp(),
+    }, wait)
 
 def update_remedy_feedback(history_id: int, effectiveness_score: int):
     """
@@ -227,6 +439,67 @@ def update_remedy_feedback(history_id: int, effectiveness_score: int):
     conn.commit()
     conn.close()
 
+RELIEF_SUMMARY_SQL = """
+    SELECT remedy_recommended, AVG(effectiveness) * 100 as effectiveness_percent, COUNT(*) as log_count
+    FROM remedy_history WHERE user_id = ? AND effectiveness != -1
+    GROUP BY remedy_recommended ORDER BY effectiveness_percent DESC
+"""
+
+def get_remedy_summary(user_id: str):
+    """
+    Per-remedy feedback for a user, best first: rows of
+    (remedy_recommended, effectiveness_percent, log_count). Pending feedback (-1) is ignored.
+    """
+    conn = get_db_connection()
+    rows = conn.execute(RELIEF_SUMMARY_SQL, (user_id,)).fetchall()
+    conn.close()
+    return rows
+
+# --- Batch Stage Re-scoring ---
+
+SYMPTOM_LOG_SLIDER_COLUMNS = ['hot_flashes', 'mood_swings', 'fatigue', 'sleep_issues', 'brain_fog']
+
+def iter_symptom_log_chunks(chunk_size: int = 10000, after_log_id: int = 0, stages=None):
+    """
+    Streams symptom_logs in log_id order as lists of rows
+    (log_id, predicted_stage, <SYMPTOM_LOG_SLIDER_COLUMNS>).
+    With `stages`, only rows whose predicted_stage is one of them are returned.
+    Uses keyset pagination (log_id > last seen), so every chunk is an index range scan.
+    """
+    stage_filter, stage_params = "", []
+    if stages is not None:
+        stage_params = list(stages)
+        stage_filter = f"AND predicted_stage IN ({', '.join('?' * len(stage_params))}) "
+    query = (
+        f"SELECT log_id, predicted_stage, {', '.join(SYMPTOM_LOG_SLIDER_COLUMNS)} "
+        f"FROM symptom_logs WHERE log_id > ? {stage_filter}ORDER BY log_id LIMIT ?"
+    )
+    conn = get_db_connection()
+    try:
+        while True:
+            rows = conn.execute(query, [after_log_id] + stage_params + [chunk_size]).fetchall()
+            if not rows:
+                return
+            yield rows
+            after_log_id = rows[-1]['log_id']
+    finally:
+        conn.close()
+
+def update_predicted_stages(stage_updates):
+    """
+    Writes [(predicted_stage, log_id), ...] back to symptom_logs in ONE transaction.
+    Returns the number of rows updated.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            cursor = conn.executemany(
+                "UPDATE symptom_logs SET predicted_stage = ? WHERE log_id = ?", stage_updates
+            )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
 # --- Auth Helper Functions ---
 
 def register_user(email, password, name):
@@ -243,19 +516,53 @@ def register_user(email, password, name):
     finally:
         conn.close()
 
+LOGIN_SQL = "SELECT id, email, name FROM users WHERE email = ? AND password = ?"
+
 def login_user(email, password):
     conn = get_db_connection()
-    row = conn.execute(
-        "SELECT id, email, name FROM users WHERE email = ? AND password = ?",
-        (email, password)
-    ).fetchone()
+    row = conn.execute(LOGIN_SQL, (email, password)).fetchone()
     conn.close()
     if row:
         return dict(row)
     return None
 
+# --- Query Plan Check ---
+# Queries run on every request, with sample parameters for EXPLAIN QUERY PLAN.
+# Checked by migrate_db() at startup and by `python database.py`.
+HOT_QUERIES = {
+    "get_remedy_summary": (RELIEF_SUMMARY_SQL, ("guest",)),
+    "get_user_profile": ("SELECT * FROM user_profile WHERE user_id = ?", ("guest",)),
+    "login_user": (LOGIN_SQL, ("guest@example.com", "")),
+    "update_remedy_feedback": ("UPDATE remedy_history SET effectiveness = ? WHERE history_id = ?", (1, 1)),
+}
+
+def check_query_plans(conn=None):
+    """
+    Runs EXPLAIN QUERY PLAN for every HOT_QUERIES entry and raises RuntimeError if any
+    of them reads a whole table (a SCAN step) instead of searching an index.
+    Returns {query name: [plan steps]}.
+    """
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    try:
+        plans = {name: [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+                 for name, (sql, params) in HOT_QUERIES.items()}
+    finally:
+        if own_conn:
+            conn.close()
+
+    scans = {name: steps for name, steps in plans.items()
+             if any(step.startswith("SCAN ") for step in steps)}
+    if scans:
+        raise RuntimeError(f"Hot queries fall back to a full table scan: {scans}")
+    return plans
+
 # --- Main execution ---
 if __name__ == '__main__':
     print("Initializing/Updating database 'menomap.db'...")
     init_db()
-    print("Database ready.")
\ No newline at end of file
+    conn = get_db_connection()
+    for name, steps in check_query_plans(conn).items():
+        print(f"  {name}: {'; '.join(steps)}")
+    print(f"Database ready (schema version {schema_version(conn)}).")
+    conn.close()
\ No newline at end of file
@@ -1,11 +1,21 @@
 import pandas as pd
 import numpy as np
-import joblib
 import os
 import random
 import warnings
 import json
+import re
+import hashlib
+import datetime
+import threading
+import uuid
 from pandas.errors import SettingWithCopyWarning
+from result_cache import LRUCache
+from feature_encoder import RequestFeatureEncoder
+from model_registry import registry, ignore_feature_name_warning
+from log_config import get_logger
+
+logger = get_logger("diet_planner")
 warnings.filterwarnings("ignore", category=SettingWithCopyWarning)
 
 # --- Configuration (Copied from your script) ---
@@ -41,6 +51,19 @@ FOOD_TAGS = {
     'processed': 'is_processed_flag'
 }
 
+# One bit per food tag, so a recipe's flags pack into a single integer (2^7 trigger combinations).
+TRIGGER_BITS = {trigger: 1 << bit for bit, trigger in enumerate(FOOD_TAGS)}
+
+EMPTY_ROWS = np.empty(0, dtype=np.intp)
+SYMPTOM_CACHE_SIZE = 4096
+SYMPTOM_CACHE_TTL_SECONDS = 6 * 60 * 60
+PLAN_CACHE_SIZE = 2048
+PLAN_CACHE_TTL_SECONDS = 24 * 60 * 60
+SCORE_CHUNK_ROWS = 250_000  # (user, recipe) rows per diet_model.predict call in batch scoring
+PLAN_SESSION_CACHE_SIZE = 512  # Generated plans kept swappable (scores + used recipes per plan)
+PLAN_SESSION_TTL_SECONDS = 24 * 60 * 60
+TOP_N_CHOICES = 5  # Each slot samples from the N best-scoring candidates
+
 # --- This is the "Answer Key" from your trained_diet_model.py ---
 # We use these keys to build the empty feature vector.
 BASE_FEATURE_KEYS = [
@@ -63,143 +86,152 @@ BASE_FEATURE_KEYS = [
 
 class AdaptiveDietPlanner:
     def __init__(self, recipe_path, symptom_model_path, symptom_features_path,
-                 diet_model_path, diet_features_path):
+                 diet_model_path, diet_features_path, deterministic_plans=False):
+        # Deterministic mode seeds slot sampling from (user, ISO week, inputs) and caches the plan
+        self.deterministic_plans = deterministic_plans
+        self.model_version = 0  # Bumped on every model reload; part of every plan cache key
         try:
             self.recipes_full = pd.read_csv(recipe_path)
-            self.symptom_model = joblib.load(symptom_model_path)
-            self.symptom_feature_names = joblib.load(symptom_features_path)
-            self.diet_model = joblib.load(diet_model_path)
-            self.diet_feature_names = joblib.load(diet_features_path)
+            self.symptom_model_path = symptom_model_path
+            self.symptom_features_path = symptom_features_path
+            self.diet_model_path = diet_model_path
+            self.diet_features_path = diet_features_path
 
             if 'is_processed_flag' in self.recipes_full.columns:
                 self.recipes_full = self.recipes_full[self.recipes_full['is_processed_flag'] == 0].copy()
+            # Positional index == row number, so precomputed arrays line up with the DataFrame
+            self.recipes_full = self.recipes_full.reset_index(drop=True)
 
             self.symptom_target_cols = list(SYMPTOM_GOALS.keys())
+            self._load_models()
+            self._build_recipe_index()
 
-            # Feature Separation Logic
-            set_diet = set(self.diet_feature_names)
-            set_user = set(self.symptom_feature_names)
-            set_recipe_cols = set(self.recipes_full.columns)
-
-            self.user_only_features = sorted(list(set_diet.intersection(set_user)))
-            self.recipe_only_features = sorted(list(set_diet.intersection(set_recipe_cols).difference(set_user)))
+            # Slider/category inputs repeat a lot, so symptom predictions are memoized
+            self.symptom_cache = LRUCache(max_size=SYMPTOM_CACHE_SIZE, ttl_seconds=SYMPTOM_CACHE_TTL_SECONDS)
+            self.plan_cache = LRUCache(max_size=PLAN_CACHE_SIZE, ttl_seconds=PLAN_CACHE_TTL_SECONDS)
+            # plan_id -> generation state, so a single slot can be swapped without regenerating
+            self.plan_sessions = LRUCache(max_size=PLAN_SESSION_CACHE_SIZE, ttl_seconds=PLAN_SESSION_TTL_SECONDS)
 
         except Exception as e:
             raise RuntimeError(f"Failed to initialize AdaptiveDietPlanner. Error: {e}. Check all file paths.")
 
-    # -------------------------
-    # 'TRANSLATION' FUNCTION (No changes)
-    # -------------------------
-    def _build_feature_vector_from_request(self, raw_data: dict) -> dict:
+    def _load_models(self, reload=False):
         """
-        Translates raw JSON request data into the feature-engineered
-        dictionary that the ML models expect.
+        Loads both models and their feature lists via the registry, then derives the
+        feature layouts that depend on them (request encoder, recipe feature matrix).
+        """
+        # Loaded once per process; forests with a packed artifact are memory-mapped
+        self.symptom_model = registry.get(self.symptom_model_path, reload=reload)
+        self.symptom_feature_names = registry.get(self.symptom_features_path, reload=reload)
+        self.diet_model = registry.get(self.diet_model_path, reload=reload)
+        self.diet_feature_names = registry.get(self.diet_features_path, reload=reload)
+
+        # Feature Separation Logic
+        set_diet = set(self.diet_feature_names)
+        set_user = set(self.symptom_feature_names)
+        set_recipe_cols = set(self.recipes_full.columns)
+
+        self.user_only_features = sorted(list(set_diet.intersection(set_user)))
+        # User-only diet columns are read straight out of the encoded symptom vector
+        self.user_vector_positions = np.array(
+            [self.symptom_feature_names.index(col) for col in self.user_only_features], dtype=np.intp)
+        self.request_encoder = RequestFeatureEncoder(self.symptom_feature_names, self.symptom_target_cols)
+        self.recipe_only_features = sorted(list(set_diet.intersection(set_recipe_cols).difference(set_user)))
+
+        self._build_recipe_feature_matrix()
+
+    def _build_recipe_feature_matrix(self):
         """
-        print(f"Starting feature vector translation for data: {raw_data}")
+        Builds the diet-model input for every recipe ONCE, in diet_feature_names order.
+        Recipe-only columns are filled here; user-only columns stay 0 and are
+        filled per request. Columns in neither set stay 0 (same as reindex fill_value=0).
+        """
+        diet_positions = {col: pos for pos, col in enumerate(self.diet_feature_names)}
 
-        # 1. Start with a dictionary of all 0s for exactly the features the model expects.
-        # This ensures the input size always matches the ML model.
-        features = {key: 0 for key in self.symptom_feature_names}
+        matrix = np.zeros((len(self.recipes_full), len(self.diet_feature_names)), dtype=np.float64)
+        for col in self.recipe_only_features:
+            matrix[:, diet_positions[col]] = self.recipes_full[col].to_numpy(dtype=np.float64)
 
-        # --- 2. MAP RAW DATA TO ENGINEERED FEATURES ---
-        # Your frontend must send this data!
+        self.recipe_feature_matrix = np.ascontiguousarray(matrix)
+        self.user_feature_positions = np.array(
+            [diet_positions[col] for col in self.user_only_features], dtype=np.intp
+        )
 
-        # === MAPPING 'age' ===
-        age = raw_data.get('age')
-        if age:
-            try:
-                age_val = int(age)
-                # Validation: ensure age is reasonable (not 0)
-                if age_val > 0:
-                    if age_val < 40:
-                        if 'age_group_simplified_younger_than_40' in features:
-                            features['age_group_simplified_younger_than_40'] = 1
-                    elif 40 <= age_val <= 49:
-                        if 'age_group_simplified_40_49' in features:
-                            features['age_group_simplified_40_49'] = 1
-                    elif 50 <= age_val <= 59:
-                        if 'age_group_simplified_50_59' in features:
-                            features['age_group_simplified_50_59'] = 1
-            except ValueError:
-                print(f"Warning: Could not parse age '{age}'")
-
-        # === MAPPING 'mood' ===
-        mood = raw_data.get('mood')
-        if mood == 'stressed':
-            features['stress_level_encoded'] = 3
-        elif mood == 'moderate':
-            features['stress_level_encoded'] = 2
-        elif mood == 'calm':
-            features['stress_level_encoded'] = 1
-
-        # === MAPPING 'symptoms' ===
-        # Use safe dictionary access with defaults
-        symptoms_data = raw_data.get('symptoms', {})
-        if isinstance(symptoms_data, dict):
-            for symptom_name in self.symptom_target_cols: # Map known symptoms
-                severity = symptoms_data.get(symptom_name, symptoms_data.get(symptom_name.replace('_severity_ternary', ''), 0))
-                
-                # Check for ternary keys (e.g., 'hot_flashes_severity_ternary')
-                feature_key_ternary = f"{symptom_name}_severity_ternary" if '_severity_ternary' not in symptom_name else symptom_name
-                if feature_key_ternary in features:
-                    features[feature_key_ternary] = int(severity)
-                
-                # Check for other symptom keys
-                elif symptom_name in features:
-                    features[symptom_name] = int(severity)
-
-        # === MAPPING 'extra' data (e.g., BMI, Cycle, etc.) ===
-        # Your frontend MUST send this in an 'extra' object
-        extra = raw_data.get('extra', {})
-
-        # Map BMI
-        bmi_cat = extra.get('bmi_category')  # e.g., "overweight"
-        if bmi_cat:
-            bmi_feature_key = f"bmi_category_{bmi_cat.lower()}"  # "bmi_category_overweight"
-            if bmi_feature_key in features:
-                features[bmi_feature_key] = 1
-
-        # Map Cycle Regularity
-        cycle = extra.get('cycle_regularity_encoded') # e.g., 2
-        if cycle:
-             features['cycle_regularity_encoded'] = int(cycle)
-
-        # Map Stage
-        stage = extra.get('self_reported_stage_encoded') # e.g., 1
-        if stage:
-            features['self_reported_stage_encoded'] = int(stage)
-        
-        # === MAPPING 'caffeine' ===
-        caffeine = raw_data.get('extra', {}).get('caffeine_intake', 'none')
-        if caffeine == 'none':
-            features['caffeine_group_caffeine_none'] = 1
-        elif caffeine == 'low':
-            features['caffeine_group_caffeine_low'] = 1
-        elif caffeine == 'moderate' or caffeine == 'high':
-            features['caffeine_group_caffeine_moderate_high'] = 1
-
-        # === MAPPING 'preferences' (Avoidances / Goals) ===
-        preferences = raw_data.get('preferences', [])
-        for pref in preferences:
-            low_pref = pref.lower()
-            if 'gluten' in low_pref: features['avoided_gluten'] = 1
-            if 'soy' in low_pref: features['avoided_soy'] = 1
-            if 'dairy' in low_pref: features['avoided_dairy'] = 1
-            
-            if 'iron' in low_pref: features['diet_goal_iron_rich'] = 1
-            if 'calcium' in low_pref: features['diet_goal_calcium_rich'] = 1
-            if 'protein' in low_pref: features['diet_goal_high_protein'] = 1
+    def reload_models(self):
+        """Reloads both models and their feature lists from disk and drops every memoized prediction and plan."""
+        self._load_models(reload=True)
+        self.model_version += 1
+        self.symptom_cache.invalidate()
+        self.plan_cache.invalidate()
+
+    def cache_stats(self):
+        """Hit-rate counters for the planner's caches."""
+        return {
+            "symptom_predictions": self.symptom_cache.stats(),
+            "plans": self.plan_cache.stats(),
+            "plan_sessions": self.plan_sessions.stats(),
+        }
+
+    @staticmethod
+    def _request_fingerprint(data):
+        """Stable hash of every plan input in the request (user_id and mode flags excluded)."""
+        inputs = {k: v for k, v in data.items() if k not in ('user_id', 'deterministic')}
+        canonical = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _build_recipe_index(self):
+        """
+        Partitions recipe row positions by (veg_nonveg_flag, Meal_Type, Region) at startup,
+        plus the coarser (veg, meal type) and (veg) levels used by the fallback cascade.
+        Each value is a sorted positional array into recipes_full.
+        """
+        def partition(columns):
+            groups = self.recipes_full.groupby(columns, sort=False).indices
+            return {key: np.asarray(rows, dtype=np.intp) for key, rows in groups.items()}
+
+        # Dense id per food_code, so "already used" is a boolean array lookup per request
+        codes, uniques = pd.factorize(self.recipes_full['food_code'], use_na_sentinel=False)
+        self.food_code_ids = codes.astype(np.intp)
+        self.n_food_codes = len(uniques)
+
+        # Pack the trigger flags into one bitmask column; a set bit means "contains trigger".
+        # Missing flag columns never set their bit, matching the old "skip unknown column" rule.
+        bitmask = np.zeros(len(self.recipes_full), dtype=np.int64)
+        for trigger, tag_col in FOOD_TAGS.items():
+            if tag_col in self.recipes_full.columns:
+                bitmask |= (self.recipes_full[tag_col] != 0).to_numpy().astype(np.int64) * TRIGGER_BITS[trigger]
+        self.recipes_full['trigger_bitmask'] = bitmask
+        self.trigger_bitmask = bitmask
+        self._allowed_rows_cache = {}  # (veg_code, trigger_mask) -> (rows, catalogue-wide bool mask)
+        # (food_name, Region) -> first row, to map a displayed meal back to its recipe
+        self.display_rows = {}
+        for row, key in enumerate(zip(self.recipes_full['food_name'], self.recipes_full['Region'])):
+            self.display_rows.setdefault(key, row)
+        self.recipe_index = {
+            'meal_region': partition(['veg_nonveg_flag', 'Meal_Type', 'Region']),
+            'meal': partition(['veg_nonveg_flag', 'Meal_Type']),
+            'diet': partition('veg_nonveg_flag'),
+        }
 
-        print(f"Built features (non-zero): { {k: v for k, v in features.items() if v > 0} }")
-        return features
+    # -------------------------
+    # 'TRANSLATION' FUNCTION (No changes)
+    # -------------------------
+    def _build_feature_vector_from_request(self, raw_data: dict) -> np.ndarray:
+        """
+        Translates raw JSON request data into the feature-engineered
+        vector (symptom_feature_names order) that the ML models expect.
+        """
+        return self.request_encoder.encode(raw_data)
 
 
     # -------------------------
     # "CONTROLLER" FUNCTION (No changes)
     # -------------------------
-    def get_diet_recommendation(self, request_data=None, user_row=None):
+    def get_diet_recommendation(self, request_data=None, user_row=None, deterministic=None):
         """
         Generate weekly diet plan based on DYNAMIC user data.
+        In deterministic mode (per call, per request 'deterministic' flag, or planner default)
+        the same user + ISO week + inputs always yields the same plan, served from cache.
         """
         # 1. Get the raw JSON data from the request
         data = request_data or {}
@@ -217,81 +249,413 @@ class AdaptiveDietPlanner:
         if not data:
             return {"error": "No input data provided."}
         
-        print(f"Service processing new data: {data}")
+        logger.debug("Service processing new data: %s", data)
+
+        if deterministic is None:
+            deterministic = bool(data.get('deterministic', self.deterministic_plans))
+
+        cache_key, rng, cached_result = self._plan_cache_context(data, deterministic)
+        if cached_result is not None:
+            return cached_result
 
         # --- 2. Translate Raw Data to ML Feature Vector ---
         try:
             # This is the NEW, critical step
-            user_profile_features = self._build_feature_vector_from_request(data)
+            user_vector = self._build_feature_vector_from_request(data)
         except Exception as e:
             return {"error": f"Failed to build feature vector: {e}"}
 
         # --- 3. Extract OTHER dynamic arguments ---
-        preferences_list = data.get('preferences', [])
-        
-        diet_preference = 'Vegetarian' # Default
-        if 'Non-Vegetarian' in preferences_list:
-            diet_preference = 'Non-Vegetarian'
-        
-        # Frontend must send 'region' and 'remedies'
-        region = data.get('extra', {}).get('region', 'South') # Default
-        remedies = data.get('remedies', ['Herbal Tea']) # Default
+        diet_preference, region, remedies = self._plan_arguments(data)
 
         # --- 4. Call the core ML logic ---
         try:
-            weekly_plan_dict = self.generate_weekly_plan(
-                user_profile_features=user_profile_features,
+            weekly_plan_dict, plan_state = self._generate_weekly_plan_state(
+                user_vector=user_vector,
                 current_remedies_list=remedies,
                 region=region,
-                diet_preference=diet_preference
+                diet_preference=diet_preference,
+                rng=rng
             )
             
-            # Format the output for JSON
-            weekly_plan_list = []
-            for day, day_data in weekly_plan_dict.items():
-                plan_day = day_data.copy()
-                plan_day['day'] = day
-                weekly_plan_list.append(plan_day)
-
-            print("✅ Recommendation generated successfully.")
-            return {"week_plan": weekly_plan_list}
+            result = self._finish_plan(weekly_plan_dict, plan_state, cache_key)
+            logger.debug("✅ Recommendation generated successfully.")
+            return result
 
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error in generate_weekly_plan: %s", e)
             return {"error": f"Error in generate_weekly_plan: {e}"}
 
-    
+    def get_diet_recommendations_batch(self, requests_list, deterministic=None):
+        """
+        Generates weekly plans for many users in one call (e.g. the nightly pre-generation job).
+        Users are planned chunk by chunk, about SCORE_CHUNK_ROWS (user, recipe) scores at a time:
+        one stacked symptom-model call and one chunked scoring pass per chunk, and each chunk's
+        score vectors are dropped once its plans are built. Returns one result per request,
+        in order, each tagged with its user_id; an invalid request only fails its own result.
+        Batch plans are not registered for swapping (no plan_id), so a large run never evicts
+        interactive users' swap sessions; swap_meal can rebuild them from the request instead.
+        """
+        results = [None] * len(requests_list)
+        pending = []  # (result index, data, cache_key, rng)
+
+        for i, data in enumerate(requests_list):
+            if not isinstance(data, dict) or not data:
+                results[i] = {"error": "Each request must be a non-empty JSON object."}
+                continue
+            use_deterministic = deterministic
+            if use_deterministic is None:
+                use_deterministic = bool(data.get('deterministic', self.deterministic_plans))
+
+            cache_key, rng, cached_result = self._plan_cache_context(data, use_deterministic)
+            if cached_result is not None:
+                results[i] = cached_result
+                continue
+            pending.append((i, data, cache_key, rng))
+
+        users_per_chunk = max(1, SCORE_CHUNK_ROWS // max(1, len(self.recipes_full)))
+        for start in range(0, len(pending), users_per_chunk):
+            self._plan_batch_chunk(pending[start:start + users_per_chunk], results)
+
+        for data, result in zip(requests_list, results):
+            result['user_id'] = data.get('user_id', 'guest') if isinstance(data, dict) else 'guest'
+        return results
+
+    def _plan_batch_chunk(self, chunk, results):
+        """Builds the plans of one get_diet_recommendations_batch chunk into `results`."""
+        user_matrix = np.zeros((len(chunk), self.request_encoder.width), dtype=np.float64)
+        jobs = []  # (matrix row, result index, cache_key, rng, diet_preference, region, remedies)
+        for row, (i, data, cache_key, rng) in enumerate(chunk):
+            try:
+                self.request_encoder.encode(data, out=user_matrix[row])
+            except Exception as e:
+                results[i] = {"error": f"Failed to build feature vector: {e}"}
+                continue
+            try:
+                plan_arguments = self._plan_arguments(data)
+            except Exception as e:
+                results[i] = {"error": f"Invalid plan arguments: {e}"}
+                continue
+            jobs.append((row, i, cache_key, rng) + plan_arguments)
+        if not jobs:
+            return
+
+        all_severities = self._predict_symptom_severities_batch(user_matrix[[job[0] for job in jobs]])
+        allowed = [self._filter_recipes(self._hard_constraints(predicted_severities), job[4])
+                   for job, predicted_severities in zip(jobs, all_severities)]
+        all_scores = self._score_recipes_batch(
+            [(user_matrix[job[0]], allowed_rows) for job, (allowed_rows, _) in zip(jobs, allowed)])
+
+        for job, (allowed_rows, allowed_mask), suitability_scores in zip(jobs, allowed, all_scores):
+            _, i, cache_key, rng, diet_preference, region, remedies = job
+            try:
+                if allowed_rows.size == 0:
+                    weekly_plan_dict, plan_state = self._no_options_plan(), None
+                else:
+                    weekly_plan_dict, plan_state = self._build_plan(
+                        suitability_scores, allowed_mask, diet_preference, region, remedies, rng)
+                results[i] = self._finish_plan(weekly_plan_dict, plan_state, cache_key, keep_session=False)
+            except Exception as e:
+                results[i] = {"error": f"Error in generate_weekly_plan: {e}"}
+
+    def _plan_cache_context(self, data, deterministic):
+        """
+        For deterministic mode returns (cache_key, seeded rng, cached result or None).
+        Otherwise returns (None, None, None) and sampling uses the global RNG.
+        """
+        if not deterministic:
+            return None, None, None
+
+        user_id = str(data.get('user_id', 'guest'))
+        iso_year, iso_week, _ = datetime.date.today().isocalendar()
+        input_hash = self._request_fingerprint(data)
+        cache_key = (user_id, iso_year, iso_week, input_hash, self.model_version)
+
+        cached = self.plan_cache.get(cache_key)
+        if cached is not None:
+            plan_id, cached_plan = cached
+            result = {"week_plan": [day.copy() for day in cached_plan]}
+            if plan_id is not None and self.plan_sessions.get(plan_id) is not None:
+                result["plan_id"] = plan_id
+            return cache_key, None, result
+
+        seed_source = f"{user_id}|{iso_year}-W{iso_week}|{input_hash}".encode('utf-8')
+        rng = np.random.default_rng(int.from_bytes(hashlib.blake2b(seed_source, digest_size=8).digest(), 'big'))
+        return cache_key, rng, None
+
+    def _finish_plan(self, weekly_plan_dict, plan_state, cache_key, keep_session=True):
+        """
+        Formats a generated plan, keeps its generation state swappable under a new
+        plan_id (unless keep_session is False), and stores it in the plan cache when
+        running deterministically.
+        """
+        weekly_plan_list = self._format_week_plan(weekly_plan_dict)
+        result = {"week_plan": weekly_plan_list}
+
+        plan_id = None
+        if plan_state is not None and keep_session:
+            plan_id = uuid.uuid4().hex
+            plan_state.update(plan=weekly_plan_dict, cache_key=cache_key, lock=threading.Lock())
+            self.plan_sessions.set(plan_id, plan_state)
+            result["plan_id"] = plan_id
+
+        if cache_key is not None:
+            self.plan_cache.set(cache_key, (plan_id, [day.copy() for day in weekly_plan_list]))
+        return result
+
+    def swap_meal(self, plan_id, day, meal_type, request_data=None, week_plan=None):
+        """
+        Replaces a single (day, meal type) slot of a previously generated plan.
+        Reuses that plan's suitability scores and used-recipe set, so no model runs;
+        the disliked recipe stays marked as used and is not offered again.
+        If the plan's session is not in this process (another worker generated it, or it
+        expired), the original request payload and the client's current week_plan rebuild
+        it with one scoring pass, the meals already on the plan marked as used.
+        Errors carry "error_type": "invalid" (bad slot or payload) or "not_found".
+        """
+        if day not in DAYS or meal_type not in MEAL_TYPES:
+            return {"error": f"Unknown slot: {day} / {meal_type}.", "error_type": "invalid"}
+
+        plan_state = self.plan_sessions.get(plan_id) if plan_id else None
+        if plan_state is None:
+            if not request_data or not week_plan:
+                return {"error": "Plan not found or expired. Please generate a new plan.",
+                        "error_type": "not_found"}
+            plan_state, error = self._rebuild_plan_state(request_data, week_plan)
+            if error:
+                return {"error": error, "error_type": "invalid"}
+            plan_id = plan_id or uuid.uuid4().hex
+            self.plan_sessions.set(plan_id, plan_state)
+
+        with plan_state['lock']:
+            selected_row = self._pick_slot(plan_state, meal_type)
+            plan = plan_state['plan']
+            if selected_row is None:
+                plan[day][meal_type] = "No suitable option found."
+            else:
+                plan_state['slot_rows'][(day, meal_type)] = selected_row
+                plan[day][meal_type] = self._augment_food_display(self.recipes_full.iloc[selected_row])
+
+            weekly_plan_list = self._format_week_plan(plan)
+            if plan_state['cache_key'] is not None:
+                self.plan_cache.set(plan_state['cache_key'], (plan_id, [d.copy() for d in weekly_plan_list]))
+
+        return {
+            "week_plan": weekly_plan_list,
+            "plan_id": plan_id,
+            "swapped": {"day": day, "meal_type": meal_type, "meal": plan[day][meal_type]},
+        }
+
+    def _rebuild_plan_state(self, request_data, week_plan):
+        """
+        Recreates a swap session from the request that generated a plan and the plan
+        itself (the week_plan list the app received). Returns (plan_state, None) or (None, error).
+        """
+        if not isinstance(request_data, dict) or not isinstance(week_plan, list):
+            return None, "'request' must be an object and 'week_plan' a list."
+        try:
+            user_vector = self._build_feature_vector_from_request(request_data)
+            diet_preference, region, _ = self._plan_arguments(request_data)
+            plan = {entry['day']: {k: v for k, v in entry.items() if k != 'day'} for entry in week_plan}
+        except Exception as e:
+            return None, f"Cannot rebuild plan from request: {e}"
+        if set(plan) != set(DAYS):
+            return None, "week_plan must contain all 7 days."
+
+        deterministic = bool(request_data.get('deterministic', self.deterministic_plans))
+        cache_key, rng, _ = self._plan_cache_context(request_data, deterministic)
+
+        predicted_severities = self._predict_symptom_severities(user_vector)
+        allowed_rows, allowed_mask = self._filter_recipes(self._hard_constraints(predicted_severities),
+                                                          diet_preference)
+        suitability_scores = self._score_recipes_batch([(user_vector, allowed_rows)])[0]
+        plan_state = self._new_plan_state(suitability_scores, allowed_mask, diet_preference, region, rng)
+
+        for day, menu in plan.items():
+            for meal_type in MEAL_TYPES:
+                row = self._row_for_display(menu.get(meal_type))
+                if row is not None:
+                    plan_state['recipes_used'][self.food_code_ids[row]] = True
+                    plan_state['slot_rows'][(day, meal_type)] = row
+        plan_state.update(plan=plan, cache_key=cache_key, lock=threading.Lock())
+        return plan_state, None
+
+    def _row_for_display(self, display):
+        """Maps an _augment_food_display string back to its recipe row (None if unknown)."""
+        if not isinstance(display, str):
+            return None
+        first_line = re.sub(r" \[!.*\]$", "", display.split("\n", 1)[0])  # drop the [!tags] suffix
+        match = re.match(r"^(.*) \((.*)\)$", first_line)
+        if match is None:
+            return None
+        return self.display_rows.get((match.group(1), match.group(2)))
+
+    @staticmethod
+    def _plan_arguments(data):
+        """Extracts (diet_preference, region, remedies) from a request."""
+        preferences_list = data.get('preferences') or []
+        
+        diet_preference = 'Vegetarian' # Default
+        if 'Non-Vegetarian' in preferences_list:
+            diet_preference = 'Non-Vegetarian'
+        
+        # Frontend must send 'region' and 'remedies' ("extra": null counts as missing)
+        region = (data.get('extra') or {}).get('region', 'South') # Default
+        remedies = data.get('remedies', ['Herbal Tea']) # Default
+        return diet_preference, region, remedies
+
+    @staticmethod
+    def _format_week_plan(weekly_plan_dict):
+        """Formats the {day: menu} plan as the JSON list the app expects."""
+        weekly_plan_list = []
+        for day, day_data in weekly_plan_dict.items():
+            plan_day = day_data.copy()
+            plan_day['day'] = day
+            weekly_plan_list.append(plan_day)
+        return weekly_plan_list
+
     # --- HELPER FUNCTIONS (No changes) ---
 
-    def _align_user_features(self, user_profile_features, feature_names_list):
-        """Aligns a single user's features to the exact list required by a model."""
-        aligned_input = pd.DataFrame(0, index=[0], columns=feature_names_list)
-        for col, value in user_profile_features.items():
-            if col in aligned_input.columns:
-                aligned_input[col] = value
-        return aligned_input[feature_names_list]
+    def _as_user_vector(self, user_profile_features):
+        """Accepts an encoded vector, or a legacy {feature: value} dict, in symptom_feature_names order."""
+        if isinstance(user_profile_features, dict):
+            return self.request_encoder.encode_mapping(user_profile_features)
+        return np.asarray(user_profile_features, dtype=np.float64)
+
+    @staticmethod
+    def _symptom_cache_key(vector):
+        canonical = vector + 0.0  # Canonicalize -0.0 so equal vectors hash equally
+        return hashlib.blake2b(canonical.tobytes(), digest_size=16).hexdigest()
+
+    def _predict_symptom_severities(self, user_vector):
+        """
+        Predicts the symptom severities for one user, memoized by a hash of the
+        feature vector aligned to symptom_feature_names.
+        """
+        return self._predict_symptom_severities_batch(user_vector.reshape(1, -1))[0]
+
+    def _predict_symptom_severities_batch(self, user_matrix):
+        """
+        Predicts severities for a matrix of user vectors: cache hits are reused and
+        every miss is scored in a single stacked symptom_model.predict call.
+        """
+        keys = [self._symptom_cache_key(vector) for vector in user_matrix]
+        severities = [self.symptom_cache.get(key) for key in keys]
+
+        misses = [i for i, cached in enumerate(severities) if cached is None]
+        if misses:
+            with ignore_feature_name_warning():  # Rows are in symptom_feature_names order
+                predictions = self.symptom_model.predict(user_matrix[misses])
+            for i, row in zip(misses, predictions):
+                row.setflags(write=False)
+                self.symptom_cache.set(keys[i], row)
+                severities[i] = row
+        return severities
+
+    def _hard_constraints(self, predicted_severities):
+        """Collects the triggers to avoid for every symptom predicted as Severe (2)."""
+        hard_constraints = []
+        num_expected = len(self.symptom_target_cols)
+        num_actual = len(predicted_severities)
+        
+        for i in range(min(num_expected, num_actual)):
+            symptom_col = self.symptom_target_cols[i]
+            if predicted_severities[i] == 2:
+                hard_constraints.extend(SYMPTOM_GOALS.get(symptom_col, {}).get('trigger_avoid', []))
+        return hard_constraints
+
+    def _score_recipes_batch(self, scoring_jobs):
+        """
+        Scores (user_vector, allowed_rows) jobs with the diet model. Users are packed
+        into chunks of up to SCORE_CHUNK_ROWS (user, recipe) rows, one predict call per chunk.
+        Returns, per job, scores indexed by row position (-inf for rows not allowed).
+        """
+        n_recipes = len(self.recipes_full)
+        results = [None] * len(scoring_jobs)
+
+        def flush(chunk, chunk_rows):
+            # Gather the precomputed recipe rows, then fill only the user-only columns.
+            X_predict = np.empty((chunk_rows, self.recipe_feature_matrix.shape[1]), dtype=np.float64)
+            offset = 0
+            for _, user_vector, rows in chunk:
+                block = X_predict[offset:offset + rows.size]
+                np.take(self.recipe_feature_matrix, rows, axis=0, out=block)
+                block[:, self.user_feature_positions] = user_vector[self.user_vector_positions]
+                offset += rows.size
+
+            with ignore_feature_name_warning():  # Columns are in diet_feature_names order
+                predictions = self.diet_model.predict(X_predict)
+            offset = 0
+            for job_index, _, rows in chunk:
+                scores = np.full(n_recipes, -np.inf)
+                scores[rows] = predictions[offset:offset + rows.size]
+                results[job_index] = scores
+                offset += rows.size
+
+        chunk, chunk_rows = [], 0
+        for job_index, (user_vector, rows) in enumerate(scoring_jobs):
+            if rows.size == 0:
+                results[job_index] = np.full(n_recipes, -np.inf)
+                continue
+            if chunk and chunk_rows + rows.size > SCORE_CHUNK_ROWS:
+                flush(chunk, chunk_rows)
+                chunk, chunk_rows = [], 0
+            chunk.append((job_index, user_vector, rows))
+            chunk_rows += rows.size
+        if chunk:
+            flush(chunk, chunk_rows)
+        return results
 
     # -------------------------
     # ✅ UPDATED FILTER FUNCTION ↓↓↓
     # -------------------------
-    def _filter_recipes(self, df, hard_constraints, diet_preference):
+    def _filter_recipes(self, hard_constraints, diet_preference):
         """
         Applies ONLY essential filters (diet pref, triggers).
         Region filter is now handled inside generate_weekly_plan.
+        Returns (sorted row positions that pass, boolean mask over recipes_full).
+        Results are memoized per (diet preference, trigger combination) and are read-only.
         """
         veg_code = VEG_MAP.get(diet_preference, 0)
-        
+        trigger_mask = 0
+        for trigger in hard_constraints:
+            trigger_mask |= TRIGGER_BITS.get(trigger, 0)
+
+        key = (veg_code, trigger_mask)
+        cached = self._allowed_rows_cache.get(key)
+        if cached is not None:
+            return cached
+
         # 💡 REMOVED: (df['Region'] == region)
-        filtered = df[df['veg_nonveg_flag'] == veg_code].copy()
+        diet_rows = self.recipe_index['diet'].get(veg_code, EMPTY_ROWS)
+        rows = diet_rows[(self.trigger_bitmask[diet_rows] & trigger_mask) == 0]
+        mask = np.zeros(len(self.recipes_full), dtype=bool)
+        mask[rows] = True
+        rows.setflags(write=False)
+        mask.setflags(write=False)
 
-        for trigger in set(hard_constraints):
-            tag_col = FOOD_TAGS.get(trigger)
-            if tag_col and tag_col in filtered.columns:
-                filtered = filtered[filtered[tag_col] == 0]
-        
-        return filtered
+        self._allowed_rows_cache[key] = (rows, mask)
+        return rows, mask
+
+    def _lookup_partition(self, veg_code, meal_type, region, level):
+        """
+        Returns the pre-partitioned row positions for one cascade level:
+        0 = meal type + region, 1 = meal type (any region), 2 = any meal type.
+        """
+        if level == 0:
+            return self.recipe_index['meal_region'].get((veg_code, meal_type, region), EMPTY_ROWS)
+        if level == 1:
+            return self.recipe_index['meal'].get((veg_code, meal_type), EMPTY_ROWS)
+        return self.recipe_index['diet'].get(veg_code, EMPTY_ROWS)
         
+    @staticmethod
+    def _top_n_rows(rows, scores, n=TOP_N_CHOICES):
+        """Returns the n best-scoring rows (unordered) using a partial partition, not a full sort."""
+        if rows.size <= n:
+            return rows
+        top = np.argpartition(-scores[rows], n - 1)[:n]
+        return rows[top]
+
     def _augment_food_display(self, recipe_row):
         """Creates a detailed, readable string for the output table."""
         tags = []
@@ -328,56 +692,67 @@ class AdaptiveDietPlanner:
     # ✅ UPDATED PLAN GENERATION FUNCTION ↓↓↓
     # -------------------------
     def generate_weekly_plan(self, user_profile_features, current_remedies_list,
-                             region='South', diet_preference='Vegetarian'):
+                             region='South', diet_preference='Vegetarian', rng=None):
         """
         Generates a unique 7-day plan with CASCADING logic
         to prevent "No suitable options" errors.
+        `rng` (a NumPy Generator) makes the top-5 sampling reproducible; defaults to np.random.
         """
-        
+        return self._generate_weekly_plan_state(self._as_user_vector(user_profile_features),
+                                                current_remedies_list, region, diet_preference, rng)[0]
+
+    def _generate_weekly_plan_state(self, user_vector, current_remedies_list,
+                                    region='South', diet_preference='Vegetarian', rng=None):
+        """Same as generate_weekly_plan, but also returns the generation state (None if no options)."""
         # 1. Predict Symptoms
-        X_symptom_aligned = self._align_user_features(user_profile_features, self.symptom_feature_names)
         # Handle the case where the model might predict fewer columns than we have in SYMPTOM_GOALS
-        predicted_severities = self.symptom_model.predict(X_symptom_aligned)[0]
-
-        hard_constraints = []
-        num_expected = len(self.symptom_target_cols)
-        num_actual = len(predicted_severities)
-        
-        for i in range(min(num_expected, num_actual)):
-            symptom_col = self.symptom_target_cols[i]
-            if predicted_severities[i] == 2:
-                hard_constraints.extend(SYMPTOM_GOALS.get(symptom_col, {}).get('trigger_avoid', []))
+        predicted_severities = self._predict_symptom_severities(user_vector)
+        hard_constraints = self._hard_constraints(predicted_severities)
         
         # 2. Apply ONLY ESSENTIAL Hard Filters
         # 💡 We no longer filter by region here.
-        recipes_filtered = self._filter_recipes(self.recipes_full, hard_constraints,
-                                                diet_preference)
+        allowed_rows, allowed_mask = self._filter_recipes(hard_constraints, diet_preference)
 
-        if recipes_filtered.empty:
-            print("🛑 Error: No recipes found matching basic diet preference and triggers. Check dataset.")
-            return {day: {'Remedy': "No options", 'Breakfast': "No options", 
-                          'Lunch': "No options", 'Evening Snacks': "No options", 
-                          'Dinner': "No options"} for day in DAYS}
+        if allowed_rows.size == 0:
+            logger.warning("🛑 No recipes found matching basic diet preference and triggers. Check dataset.")
+            return self._no_options_plan(), None
 
         # 3. Predict Suitability Score for ALL suitable recipes
-        X_user_single = self._align_user_features(user_profile_features, self.user_only_features)
-        N = len(recipes_filtered)
-        X_user_repeated = np.repeat(X_user_single.values, N, axis=0)
-        X_user_repeated_df = pd.DataFrame(X_user_repeated, columns=self.user_only_features)
-        
-        X_recipe_features_aligned = recipes_filtered.reindex(columns=self.recipe_only_features, fill_value=0)
-
-        X_predict_raw = pd.concat([X_user_repeated_df.reset_index(drop=True),
-                                   X_recipe_features_aligned.reset_index(drop=True)], axis=1)
-
-        X_predict_aligned = X_predict_raw.reindex(columns=self.diet_feature_names, fill_value=0)
-        suitability_scores = self.diet_model.predict(X_predict_aligned)
-
-        recipes_filtered.loc[:, 'suitability_score'] = suitability_scores
+        # Scores are indexed by row position; rows that failed the hard filters are never candidates.
+        suitability_scores = self._score_recipes_batch([(user_vector, allowed_rows)])[0]
+
+        return self._build_plan(suitability_scores, allowed_mask, diet_preference, region,
+                                current_remedies_list, rng)
+
+    @staticmethod
+    def _no_options_plan():
+        return {day: {'Remedy': "No options", 'Breakfast': "No options", 
+                      'Lunch': "No options", 'Evening Snacks': "No options", 
+                      'Dinner': "No options"} for day in DAYS}
+
+    def _new_plan_state(self, suitability_scores, allowed_mask, diet_preference, region, rng=None):
+        """Generation state for one plan: what _pick_slot reads and updates."""
+        return {
+            'scores': suitability_scores,
+            'allowed_mask': allowed_mask,
+            'veg_code': VEG_MAP.get(diet_preference, 0),
+            'region': region,
+            'rng': np.random if rng is None else rng,
+            'recipes_used': np.zeros(self.n_food_codes, dtype=bool),  # indexed by food_code id
+            'slot_candidates': {},  # (meal_type, level) -> allowed rows of that index partition
+            'slot_rows': {},  # (day, meal_type) -> selected row position
+        }
+
+    def _build_plan(self, suitability_scores, allowed_mask, diet_preference, region,
+                    current_remedies_list, rng=None):
+        """
+        Fills the 7 x 4 meal slots from precomputed suitability scores (cascading fallbacks).
+        Returns (plan, state); the state is what swap_meal needs to re-pick a single slot.
+        """
+        plan_state = self._new_plan_state(suitability_scores, allowed_mask, diet_preference, region, rng)
 
         # 5. Generate Plan with CASCADING LOGIC
         plan = {}
-        recipes_used = set()
         
         if not current_remedies_list:
              current_remedies_list = ["Stay Hydrated"]
@@ -387,43 +762,45 @@ class AdaptiveDietPlanner:
             daily_menu = {'Remedy': remedy_item}
 
             for meal_type in MEAL_TYPES:
-                
-                # --- This is the new logic ---
-                
-                # A. Prioritize: Exact Meal Type + User's Region
-                meal_options = recipes_filtered[
-                    (recipes_filtered['Meal_Type'] == meal_type) &
-                    (recipes_filtered['Region'] == region) &
-                    (~recipes_filtered['food_code'].isin(recipes_used))
-                ].copy()
-
-                # B. Fallback 1: Exact Meal Type + ANY Region
-                if meal_options.empty:
-                    print(f"Fallback 1: No {meal_type} in {region}. Widening region.")
-                    meal_options = recipes_filtered[
-                        (recipes_filtered['Meal_Type'] == meal_type) &
-                        (~recipes_filtered['food_code'].isin(recipes_used))
-                    ].copy()
-
-                # C. Fallback 2: ANY Meal Type + ANY Region (to fill the slot)
-                if meal_options.empty:
-                    print(f"Fallback 2: No {meal_type} found at all. Using any suitable recipe.")
-                    meal_options = recipes_filtered[~recipes_filtered['food_code'].isin(recipes_used)].copy()
-
-                # ---
-                
-                if not meal_options.empty:
-                    # Rank by ML score and pick from top 5
-                    ranked_options = meal_options.sort_values(by='suitability_score', ascending=False)
-                    top_n = ranked_options.head(5)
-                    selected_recipe_row = top_n.sample(n=min(1, len(top_n))).iloc[0]
-                    
-                    daily_menu[meal_type] = self._augment_food_display(selected_recipe_row)
-                    recipes_used.add(selected_recipe_row['food_code'])
+                selected_row = self._pick_slot(plan_state, meal_type)
+                if selected_row is not None:
+                    daily_menu[meal_type] = self._augment_food_display(self.recipes_full.iloc[selected_row])
+                    plan_state['slot_rows'][(day, meal_type)] = selected_row
                 else:
                     # This should rarely happen now
                     daily_menu[meal_type] = "No suitable option found."
 
             plan[day] = daily_menu
 
-        return plan
+        return plan, plan_state
+
+    def _pick_slot(self, plan_state, meal_type):
+        """
+        Picks one unused recipe row for a meal slot (or None) and marks it used.
+        """
+        region = plan_state['region']
+        recipes_used = plan_state['recipes_used']
+        slot_candidates = plan_state['slot_candidates']
+
+        # --- This is the new logic ---
+        # A. Prioritize: Exact Meal Type + User's Region
+        # B. Fallback 1: Exact Meal Type + ANY Region
+        # C. Fallback 2: ANY Meal Type + ANY Region (to fill the slot)
+        for level in range(3):
+            key = (meal_type, level)
+            if key not in slot_candidates:
+                partition = self._lookup_partition(plan_state['veg_code'], meal_type, region, level)
+                slot_candidates[key] = partition[plan_state['allowed_mask'][partition]]
+            rows = slot_candidates[key]
+            rows = rows[~recipes_used[self.food_code_ids[rows]]]
+            if rows.size:
+                # Rank by ML score and pick from top 5
+                top_n = self._top_n_rows(rows, plan_state['scores'])
+                selected_row = int(plan_state['rng'].choice(top_n))
+                recipes_used[self.food_code_ids[selected_row]] = True
+                return selected_row
+            if level == 0:
+                logger.debug("Fallback 1: No %s in %s. Widening region.", meal_type, region)
+            elif level == 1:
+                logger.debug("Fallback 2: No %s found at all. Using any suitable recipe.", meal_type)
+        return None
@@ -1,24 +1,13 @@
 import pandas as pd
-import joblib
 import os
-import numpy as np
-from sklearn.model_selection import train_test_split
-from sklearn.multioutput import MultiOutputClassifier
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import f1_score
+from model_registry import registry, resolve_model_path
 
 # --- Configuration ---
-# --- ABSOLUTE PATH DEFINITION ---
-# Base path for all ML model artifacts (where final_feature_names.pkl resides)
-ML_MODELS_DIR_ABSOLUTE = r'C:\Users\hp\Desktop\MenoMapApp\ML_MODELS'
-
-# File names (relative to ML_MODELS_DIR_ABSOLUTE)
+# Artifacts are resolved relative to the project's model folder and unpickled
+# once per process by the shared model registry.
 TOP_FEATURES_FILE = 'final_feature_names.pkl' 
 REMEDY_MODELS_SUBDIR = 'Relief_Efficacy_Models'
-
-REMEDY_MODELS_DIR = os.path.join(ML_MODELS_DIR_ABSOLUTE, REMEDY_MODELS_SUBDIR)
 MODEL_BASE_NAME = 'model_'
-# --- END ABSOLUTE PATH CONFIG ---
 
 # Define the treatments/practices that we want to model efficacy for
 TREATMENT_NAMES = [
@@ -99,12 +88,11 @@ def recommend_relief(user_profile_data, target_symptom, current_severity):
     and recommends the remedy resulting in the lowest predicted severity.
     """
     
-    # 1. Robustly Load Profile Feature Names using the absolute path
+    # 1. Robustly Load Profile Feature Names (cached by the registry after the first call)
     try:
-        model_names_path = os.path.join(ML_MODELS_DIR_ABSOLUTE, TOP_FEATURES_FILE)
-        profile_feature_names = joblib.load(model_names_path)
+        profile_feature_names = registry.load(TOP_FEATURES_FILE)
     except FileNotFoundError:
-        return {"error": f"Feature names file not found. Script looked for: {model_names_path}"}
+        return {"error": f"Feature names file not found. Script looked for: {resolve_model_path(TOP_FEATURES_FILE)}"}
 
     best_remedy = None
     min_predicted_severity = 3
@@ -116,15 +104,12 @@ def recommend_relief(user_profile_data, target_symptom, current_severity):
     
     for remedy_name in TREATMENT_NAMES:
         
-        # Build absolute paths for the remedy models
-        model_path = os.path.join(REMEDY_MODELS_DIR, f'{MODEL_BASE_NAME}{remedy_name}.pkl')
-        features_path = os.path.join(REMEDY_MODELS_DIR, f'features_{remedy_name}.pkl')
-        
-        if not os.path.exists(model_path):
+        model_file = f'{MODEL_BASE_NAME}{remedy_name}.pkl'
+        if not registry.exists(REMEDY_MODELS_SUBDIR, model_file):
             continue
             
-        model = joblib.load(model_path)
-        remedy_feature_names = joblib.load(features_path)
+        model = registry.load(REMEDY_MODELS_SUBDIR, model_file)
+        remedy_feature_names = registry.load(REMEDY_MODELS_SUBDIR, f'features_{remedy_name}.pkl')
         
         # 2. Align Input Data for the current remedy model
         X_aligned = pd.DataFrame(0, index=[0], columns=remedy_feature_names)
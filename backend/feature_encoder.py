@@ -0,0 +1,151 @@
+import numpy as np
+from log_config import get_logger
+
+logger = get_logger("feature_encoder")
+
+# --- Request -> feature mapping tables (shared by the symptom, diet and relief paths) ---
+AGE_GROUP_FEATURES = [
+    # (lower bound, upper bound, feature)
+    (1, 39, 'age_group_simplified_younger_than_40'),
+    (40, 49, 'age_group_simplified_40_49'),
+    (50, 59, 'age_group_simplified_50_59'),
+]
+MOOD_STRESS_LEVELS = {'stressed': 3, 'moderate': 2, 'calm': 1}
+CAFFEINE_FEATURES = {
+    'none': 'caffeine_group_caffeine_none',
+    'low': 'caffeine_group_caffeine_low',
+    'moderate': 'caffeine_group_caffeine_moderate_high',
+    'high': 'caffeine_group_caffeine_moderate_high',
+}
+# Substring found in a preference -> feature set to 1
+PREFERENCE_KEYWORDS = [
+    ('gluten', 'avoided_gluten'), ('soy', 'avoided_soy'), ('dairy', 'avoided_dairy'),
+    ('iron', 'diet_goal_iron_rich'), ('calcium', 'diet_goal_calcium_rich'),
+    ('protein', 'diet_goal_high_protein'),
+]
+
+
+class RequestFeatureEncoder:
+    """
+    Compiled translator from raw request JSON to a model-ordered feature row.
+    Every target column position is resolved once at construction, so encoding
+    writes straight into a preallocated NumPy row instead of building dicts.
+    Features the model does not use are skipped at compile time.
+    """
+    def __init__(self, feature_names, symptom_target_cols=()):
+        self.feature_names = list(feature_names)
+        self.positions = {name: pos for pos, name in enumerate(self.feature_names)}
+        position = self.positions.get
+
+        self._age_groups = [(low, high, position(col)) for low, high, col in AGE_GROUP_FEATURES
+                            if col in self.positions]
+        self._stress_position = position('stress_level_encoded')
+        self._cycle_position = position('cycle_regularity_encoded')
+        self._stage_position = position('self_reported_stage_encoded')
+        self._caffeine_positions = {level: position(col) for level, col in CAFFEINE_FEATURES.items()
+                                    if col in self.positions}
+        self._preference_keywords = [(keyword, position(col)) for keyword, col in PREFERENCE_KEYWORDS
+                                     if col in self.positions]
+
+        # (request key, short request key, feature position) for every mapped symptom
+        self._symptoms = []
+        for symptom_name in symptom_target_cols:
+            ternary_key = symptom_name if '_severity_ternary' in symptom_name else f"{symptom_name}_severity_ternary"
+            target = ternary_key if ternary_key in self.positions else symptom_name
+            if target in self.positions:
+                short_key = symptom_name.replace('_severity_ternary', '')
+                self._symptoms.append((symptom_name, short_key, self.positions[target]))
+
+    @property
+    def width(self):
+        return len(self.feature_names)
+
+    def encode(self, raw_data, out=None):
+        """
+        Encodes one request ({age, mood, symptoms, extra, preferences}) into a row.
+        Writes into `out` (zeroed first) when given, otherwise allocates a new row.
+        """
+        row = np.zeros(self.width, dtype=np.float64) if out is None else out
+        if out is not None:
+            row.fill(0)
+
+        # === 'age' ===
+        age = raw_data.get('age')
+        if age and self._age_groups:
+            try:
+                age_val = int(age)
+            except ValueError:
+                age_val = 0  # Unparseable age: leave every age group at 0
+            for low, high, pos in self._age_groups:
+                if low <= age_val <= high:
+                    row[pos] = 1
+                    break
+
+        # === 'mood' ===
+        stress = MOOD_STRESS_LEVELS.get(raw_data.get('mood'))
+        if stress is not None and self._stress_position is not None:
+            row[self._stress_position] = stress
+
+        # === 'symptoms' ===
+        symptoms_data = raw_data.get('symptoms', {})
+        if isinstance(symptoms_data, dict):
+            for symptom_name, short_key, pos in self._symptoms:
+                row[pos] = int(symptoms_data.get(symptom_name, symptoms_data.get(short_key, 0)))
+
+        # === 'extra' (BMI, cycle, stage, caffeine) ===
+        extra = raw_data.get('extra', {})
+
+        bmi_cat = extra.get('bmi_category')
+        if bmi_cat:
+            pos = self.positions.get(f"bmi_category_{bmi_cat.lower()}")
+            if pos is not None:
+                row[pos] = 1
+
+        cycle = extra.get('cycle_regularity_encoded')
+        if cycle and self._cycle_position is not None:
+            row[self._cycle_position] = int(cycle)
+
+        stage = extra.get('self_reported_stage_encoded')
+        if stage and self._stage_position is not None:
+            row[self._stage_position] = int(stage)
+
+        pos = self._caffeine_positions.get(extra.get('caffeine_intake', 'none'))
+        if pos is not None:
+            row[pos] = 1
+
+        # === 'preferences' (Avoidances / Goals) ===
+        for pref in raw_data.get('preferences', []):
+            low_pref = pref.lower()
+            for keyword, pos in self._preference_keywords:
+                if keyword in low_pref:
+                    row[pos] = 1
+
+        return row
+
+    def encode_many(self, requests_list):
+        """Encodes many requests into one (n_requests, n_features) matrix."""
+        matrix = np.zeros((len(requests_list), self.width), dtype=np.float64)
+        for i, raw_data in enumerate(requests_list):
+            self.encode(raw_data, out=matrix[i])
+        return matrix
+
+    def encode_mapping(self, values, out=None):
+        """
+        Aligns an already-engineered {feature: value} dict (e.g. a stored user profile)
+        to this encoder's column order. Unknown keys are ignored; None becomes NaN.
+        A value that is not numeric also becomes NaN (logged), so one bad field
+        only affects the models that use that column instead of failing the row.
+        """
+        row = np.zeros(self.width, dtype=np.float64) if out is None else out
+        if out is not None:
+            row.fill(0)
+        for col, value in values.items():
+            pos = self.positions.get(col)
+            if pos is None:
+                continue
+            try:
+                row[pos] = np.nan if value is None else float(value)
+            except (TypeError, ValueError):
+                logger.warning("⚠️ Non-numeric value for %s: %r; treating it as missing.", col, value)
+                row[pos] = np.nan
+        return row
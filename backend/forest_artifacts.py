@@ -0,0 +1,319 @@
+"""
+Memory-mapped artifact format for the tree-ensemble models in ML_MODELS.
+
+joblib.load() copies every tree's node array into the process heap (sklearn's
+Tree.__setstate__ copies the nodes even from a memory-mapped pickle), so each
+worker holds its own copy of every forest. A packed forest is a directory of
+plain .npy arrays next to the .pkl:
+
+    ML_MODELS/stage_prediction_model.pkl
+    ML_MODELS/stage_prediction_model.forest/meta.json, feature.npy, threshold.npy, ...
+
+The arrays are opened read-only with np.load(mmap_mode='r'). The OS page cache
+shares them across processes, and startup reads only the pages it touches.
+
+PackedForest is also the compiled inference engine: it walks all trees of a model
+at once with vectorized NumPy traversal. A .pkl forest without an artifact is
+compiled in memory on load (compile_forest), so every path uses the same engine.
+
+Export the artifacts after (re)training:
+
+    python forest_artifacts.py                 # every supported .pkl in ML_MODELS
+    python forest_artifacts.py path/to/model.pkl
+"""
+import json
+import os
+import sys
+import joblib
+import numpy as np
+from log_config import get_logger
+
+logger = get_logger("forest_artifacts")
+
+FOREST_DIR_SUFFIX = '.forest'
+FORMAT_VERSION = 2  # 2: (left, right) children pairs, leaves are self-loops, meta.json records max_depth
+NODE_ARRAYS = ('feature', 'threshold', 'children', 'missing_go_to_left', 'value')
+TREE_LEAF = -1
+# Rows walked together; keeps the (n_trees, rows) node matrix cache-sized on big batches
+APPLY_CHUNK_ROWS = 512
+# Pickled forests are compiled to a PackedForest on load unless this is "0"
+COMPILED_FORESTS = os.environ.get("MENOMAP_COMPILED_FORESTS", "1") == "1"
+
+
+def artifact_dir_for(model_path):
+    """The packed-forest directory that sits next to a .pkl model."""
+    return os.path.splitext(model_path)[0] + FOREST_DIR_SUFFIX
+
+
+# --- Packing ---
+
+def _forest_groups(model):
+    """
+    Returns (kind, [fitted forest, ...]) for the model types used by the backend:
+    a forest classifier/regressor, or a MultiOutputClassifier of single-output forest classifiers.
+    """
+    from sklearn.ensemble import (ExtraTreesClassifier, ExtraTreesRegressor,
+                                  RandomForestClassifier, RandomForestRegressor)
+    from sklearn.multioutput import MultiOutputClassifier
+    ForestClassifier = (RandomForestClassifier, ExtraTreesClassifier)
+    ForestRegressor = (RandomForestRegressor, ExtraTreesRegressor)
+
+    if isinstance(model, MultiOutputClassifier):
+        if all(isinstance(est, ForestClassifier) and est.n_outputs_ == 1 for est in model.estimators_):
+            return 'multioutput_classifier', list(model.estimators_)
+    elif isinstance(model, ForestClassifier) and model.n_outputs_ == 1:
+        return 'classifier', [model]
+    elif isinstance(model, ForestRegressor):
+        return 'regressor', [model]
+    raise TypeError(f"Unsupported model type for a packed forest: {type(model).__name__}")
+
+
+def pack_forest(model):
+    """
+    Flattens every tree of `model` into one set of node arrays.
+    children[node] holds the absolute (left, right) node indices and every leaf points to itself,
+    so all trees can be walked together for a fixed max_depth steps. Leaf values are
+    padded to the largest number of classes.
+    Returns (meta, {array name: ndarray}, [classes per forest]).
+    """
+    kind, forests = _forest_groups(model)
+    is_classifier = kind != 'regressor'
+    n_outputs = 1 if is_classifier else forests[0].n_outputs_
+    max_classes = max(len(forest.classes_) for forest in forests) if is_classifier else 1
+
+    trees = [tree.tree_ for forest in forests for tree in forest.estimators_]
+    n_nodes = sum(tree.node_count for tree in trees)
+    arrays = {
+        'feature': np.zeros(n_nodes, dtype=np.int32),
+        'threshold': np.zeros(n_nodes, dtype=np.float64),
+        'children': np.zeros((n_nodes, 2), dtype=np.int32),
+        'missing_go_to_left': np.zeros(n_nodes, dtype=np.uint8),
+        'value': np.zeros((n_nodes, n_outputs, max_classes), dtype=np.float64),
+    }
+    tree_roots = []
+    offset = 0
+    for forest in forests:
+        n_classes = len(forest.classes_) if is_classifier else 1
+        for tree in (est.tree_ for est in forest.estimators_):
+            end = offset + tree.node_count
+            internal = tree.children_left != TREE_LEAF
+            self_loop = np.arange(offset, end)
+            arrays['feature'][offset:end] = np.where(internal, tree.feature, 0)
+            arrays['threshold'][offset:end] = tree.threshold
+            arrays['children'][offset:end, 0] = np.where(internal, tree.children_left + offset, self_loop)
+            arrays['children'][offset:end, 1] = np.where(internal, tree.children_right + offset, self_loop)
+            if hasattr(tree, 'missing_go_to_left'):
+                arrays['missing_go_to_left'][offset:end] = tree.missing_go_to_left
+
+            # sklearn >= 1.4 stores classifier leaf values as class fractions and
+            # predict_proba returns them as-is, so they are copied unchanged
+            arrays['value'][offset:end, :, :n_classes] = tree.value[:, :, :n_classes]
+
+            tree_roots.append(offset)
+            offset = end
+    arrays['tree_roots'] = np.array(tree_roots, dtype=np.int32)
+
+    classes = [np.asarray(forest.classes_) for forest in forests] if is_classifier else []
+    feature_names = getattr(model, 'feature_names_in_', None)
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'kind': kind,
+        'model_type': type(model).__name__,
+        'n_features': int(forests[0].n_features_in_),
+        'feature_names': None if feature_names is None else [str(name) for name in feature_names],
+        'n_outputs': int(n_outputs),
+        'trees_per_forest': [len(forest.estimators_) for forest in forests],
+        'max_depth': int(max(tree.max_depth for tree in trees)),
+    }
+    return meta, arrays, classes
+
+
+def export_forest(model, out_dir):
+    """Writes `model` as a packed-forest directory (meta.json + one .npy per array)."""
+    meta, arrays, classes = pack_forest(model)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, f'{name}.npy'), array, allow_pickle=False)
+    for i, forest_classes in enumerate(classes):
+        np.save(os.path.join(out_dir, f'classes_{i}.npy'), forest_classes, allow_pickle=False)
+    # meta.json is written last: its presence (and mtime) marks a complete artifact
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return out_dir
+
+
+# --- Inference ---
+
+class PackedForest:
+    """
+    Compiled tree-ensemble predictor over packed node arrays (memory-mapped or in memory).
+    Every tree of the model is walked at once: each of max_depth steps is a handful of
+    NumPy gathers over an (n_trees, n_rows) node matrix, instead of one sklearn
+    estimator call per tree. Results match the sklearn model it was packed from:
+    X is cast to float32 like sklearn does, NaN follows each node's missing_go_to_left,
+    and tree outputs are summed in tree order.
+    """
+    def __init__(self, meta, arrays, classes):
+        self.meta = meta
+        self.kind = meta['kind']
+        self.n_features_in_ = meta['n_features']
+        if meta.get('feature_names') is not None:
+            self.feature_names_in_ = np.array(meta['feature_names'], dtype=object)
+        self.n_outputs_ = meta['n_outputs']
+        self.max_depth = meta['max_depth']
+        # Plain ndarray views: indexing an np.memmap subclass is slower, the pages stay shared
+        for name in NODE_ARRAYS + ('tree_roots',):
+            setattr(self, name, np.asarray(arrays[name]))
+        self.missing_go_to_left = self.missing_go_to_left.view(np.bool_)
+        self._children_flat = self.children.reshape(-1)  # children_flat[2 * node + go_right]
+        self.tree_roots = self.tree_roots.astype(np.int32)  # Node ids stay int32 while walking
+
+        # Tree positions of each forest (one forest per output for a MultiOutputClassifier)
+        bounds = np.cumsum([0] + meta['trees_per_forest'])
+        self._forest_trees = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        self._classes = classes
+        if self.kind == 'classifier':
+            self.classes_ = classes[0]
+        elif self.kind == 'multioutput_classifier':
+            self.classes_ = classes
+
+    def _validate(self, X):
+        if hasattr(X, 'columns') and getattr(self, 'feature_names_in_', None) is not None:
+            X = X[list(self.feature_names_in_)]
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2:
+            raise ValueError(f"Expected a 2D array, got a {X.ndim}D array instead.")
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[1]} features, but {self.meta['model_type']} "
+                             f"is expecting {self.n_features_in_} features as input.")
+        if np.isinf(X).any():
+            raise ValueError("Input X contains infinity or a value too large for dtype('float32').")
+        return X
+
+    def _apply(self, X):
+        """Leaf index reached by every row of X in every tree, shape (n_trees, n_rows)."""
+        if X.shape[0] > APPLY_CHUNK_ROWS:
+            leaves = np.empty((len(self.tree_roots), X.shape[0]), dtype=np.intp)
+            for start in range(0, X.shape[0], APPLY_CHUNK_ROWS):
+                leaves[:, start:start + APPLY_CHUNK_ROWS] = self._apply(X[start:start + APPLY_CHUNK_ROWS])
+            return leaves
+
+        n_rows = X.shape[0]
+        # X_flat[feature * n_rows + row], widened once so comparing with the float64 thresholds needs no cast
+        X_flat = np.ascontiguousarray(X.T, dtype=np.float64).reshape(-1)
+        rows = np.arange(n_rows, dtype=np.int32)
+        has_missing = np.isnan(X).any()
+        node = np.repeat(self.tree_roots[:, None], n_rows, axis=1)
+        # Flat take() and in-place index arithmetic: no 2D fancy indexing or temporaries per step
+        for _ in range(self.max_depth):
+            position = self.feature.take(node)
+            position *= n_rows
+            position += rows
+            x = X_flat.take(position)
+            go_right = x > self.threshold.take(node)
+            if has_missing:  # NaN compares False: its direction comes from the node
+                missing = np.isnan(x)
+                go_right[missing] = ~self.missing_go_to_left.take(node[missing])
+            # Leaves loop to themselves, so finished trees simply stay put
+            node *= 2
+            node += go_right
+            node = self._children_flat.take(node)
+        return node
+
+    @staticmethod
+    def _sum_trees(leaf_values):
+        """Adds per-tree outputs one tree at a time, in the order sklearn accumulates them."""
+        total = leaf_values[0].copy()
+        for tree_values in leaf_values[1:]:
+            total += tree_values
+        return total
+
+    def _forest_proba(self, forest, leaves):
+        n_classes = len(self._classes[forest])
+        trees = self._forest_trees[forest]
+        proba = self._sum_trees(self.value[leaves[trees], 0, :n_classes])
+        proba /= trees.stop - trees.start
+        return proba
+
+    def predict_proba(self, X):
+        if self.kind == 'regressor':
+            raise AttributeError("predict_proba is not available for a regressor.")
+        leaves = self._apply(self._validate(X))
+        probas = [self._forest_proba(forest, leaves) for forest in range(len(self._forest_trees))]
+        return probas[0] if self.kind == 'classifier' else probas
+
+    def predict(self, X):
+        leaves = self._apply(self._validate(X))
+        if self.kind == 'regressor':
+            y_hat = self._sum_trees(self.value[leaves, :, 0])
+            y_hat /= leaves.shape[0]
+            return y_hat[:, 0] if self.n_outputs_ == 1 else y_hat
+
+        predictions = [self._classes[forest].take(np.argmax(self._forest_proba(forest, leaves), axis=1), axis=0)
+                       for forest in range(len(self._forest_trees))]
+        return predictions[0] if self.kind == 'classifier' else np.asarray(predictions).T
+
+
+def compile_forest(model):
+    """Packs a fitted sklearn forest into an in-memory PackedForest (no artifact on disk)."""
+    return PackedForest(*pack_forest(model))
+
+
+def load_forest(forest_dir, mmap_mode='r'):
+    """Opens a packed-forest directory; the node arrays are memory-mapped read-only."""
+    with open(os.path.join(forest_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported packed forest format: {meta.get('format_version')}")
+    arrays = {name: np.load(os.path.join(forest_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in NODE_ARRAYS + ('tree_roots',)}
+    n_forests = len(meta['trees_per_forest']) if meta['kind'] != 'regressor' else 0
+    classes = [np.load(os.path.join(forest_dir, f'classes_{i}.npy')) for i in range(n_forests)]
+    return PackedForest(meta, arrays, classes)
+
+
+def load_model(model_path):
+    """
+    Loads a model artifact: the packed forest next to `model_path` when one exists
+    and is newer than the .pkl, otherwise the pickle itself via joblib. A pickled
+    forest is compiled in memory (set MENOMAP_COMPILED_FORESTS=0 to keep sklearn's).
+    """
+    forest_dir = artifact_dir_for(model_path)
+    meta_path = os.path.join(forest_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        if not os.path.exists(model_path) or os.path.getmtime(meta_path) >= os.path.getmtime(model_path):
+            try:
+                return load_forest(forest_dir)
+            except ValueError as e:
+                logger.warning("⚠️ %s; loading %s instead. Re-run forest_artifacts.py.", e, model_path)
+        else:
+            logger.warning("⚠️ Packed forest %s is older than %s; loading the pickle instead.", forest_dir, model_path)
+
+    model = joblib.load(model_path)
+    if COMPILED_FORESTS:
+        try:
+            return compile_forest(model)
+        except TypeError:
+            pass  # Not a forest (feature-name lists, other estimators)
+    return model
+
+
+# --- Export CLI ---
+if __name__ == '__main__':
+    from model_registry import resolve_model_path
+
+    if len(sys.argv) > 1:
+        model_paths = sys.argv[1:]
+    else:
+        models_dir = resolve_model_path()
+        model_paths = [os.path.join(root, name) for root, _, files in os.walk(models_dir)
+                       for name in sorted(files) if name.endswith('.pkl')]
+
+    for model_path in model_paths:
+        try:
+            model = joblib.load(model_path)
+            _forest_groups(model)
+        except Exception:
+            continue  # Feature-name lists and other non-forest pickles
+        out_dir = export_forest(model, artifact_dir_for(model_path))
+        print(f"✅ Packed {os.path.basename(model_path)} -> {out_dir}")
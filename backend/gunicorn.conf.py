@@ -0,0 +1,42 @@
+"""
+Preload-then-fork serving for the MenoMap backend (Linux / macOS).
+
+    cd backend
+    gunicorn -c gunicorn.conf.py
+
+The app (and every model) is imported once in the master, then the workers are
+forked from it. Model arrays are shared copy-on-write between the workers, so
+adding a worker costs only the pages that worker writes to.
+"""
+import gc
+import os
+
+from memory_report import process_memory
+
+wsgi_app = "app:app"
+bind = os.environ.get("MENOMAP_BIND", "0.0.0.0:5002")
+workers = int(os.environ.get("MENOMAP_WORKERS", "4"))
+timeout = 120
+
+# Load app.py, and with it every model, in the master before forking
+preload_app = True
+# Threads do not survive fork(), so models must be fully loaded in the master, not warmed lazily
+os.environ["MENOMAP_LAZY_MODELS"] = "0"
+
+
+def when_ready(server):
+    # Move every object loaded so far into the permanent GC generation. Otherwise the
+    # workers' garbage collector writes to the GC header of each of these objects and
+    # the kernel copies the page holding it into the worker (copy-on-write). The large
+    # NumPy buffers (tree nodes, recipe features) live outside the object headers, so
+    # they stay shared as long as nothing writes to them.
+    gc.collect()
+    gc.freeze()
+    server.log.info("🧊 Froze %d preloaded objects before forking workers", gc.get_freeze_count())
+
+
+def post_worker_init(worker):
+    memory = process_memory()
+    if memory:
+        worker.log.info("Worker %s memory: shared %s MB, private %s MB",
+                        worker.pid, memory['shared'], memory['private'])
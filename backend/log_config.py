@@ -0,0 +1,52 @@
+import logging
+import os
+import random
+import sys
+
+# --- Configuration (environment overrides) ---
+# MENOMAP_LOG_LEVEL:       DEBUG logs every request payload; the INFO default keeps the hot paths quiet.
+# MENOMAP_LOG_SAMPLE_RATE: fraction of DEBUG/INFO records kept (warnings and errors are never sampled).
+LOG_LEVEL = os.environ.get("MENOMAP_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("MENOMAP_LOG_SAMPLE_RATE", "1.0"))
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+ROOT_LOGGER_NAME = "menomap"
+_configured = False
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps roughly `rate` of the DEBUG/INFO records; WARNING and above always pass."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+def configure_logging(level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE):
+    """Attaches one stderr handler to the 'menomap' logger. Safe to call more than once."""
+    global _configured
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level)
+    if not _configured:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        if sample_rate < 1.0:
+            handler.addFilter(SamplingFilter(sample_rate))
+        root.addHandler(handler)
+        root.propagate = False
+        _configured = True
+    return root
+
+
+def get_logger(name):
+    """
+    Returns a 'menomap.<name>' logger. Use lazy %-style arguments
+    (logger.debug("data: %s", data)) so disabled levels cost only a level check.
+    """
+    if not _configured:
+        configure_logging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
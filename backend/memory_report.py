@@ -0,0 +1,70 @@
+"""
+Shared vs. private memory of the backend's worker processes (Linux only).
+
+Reads /proc/<pid>/smaps_rollup. After a preload-then-fork start, model memory
+loaded in the master shows up as "shared" in every worker; pages a worker has
+written to (copy-on-write) show up as "private".
+
+    python memory_report.py <gunicorn master pid>
+"""
+import argparse
+import os
+
+SMAPS_FIELDS = {
+    'Rss': 'rss', 'Pss': 'pss',
+    'Shared_Clean': 'shared_clean', 'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean', 'Private_Dirty': 'private_dirty',
+}
+
+
+def process_memory(pid="self"):
+    """Returns {rss, pss, shared, private, ...} in MB for one process, or {} if unavailable."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+
+    memory = {}
+    for line in lines:
+        parts = line.split()
+        key = SMAPS_FIELDS.get(parts[0].rstrip(':')) if parts else None
+        if key:
+            memory[key] = round(int(parts[1]) / 1024, 1)  # kB -> MB
+    if memory:
+        memory['shared'] = round(memory.get('shared_clean', 0) + memory.get('shared_dirty', 0), 1)
+        memory['private'] = round(memory.get('private_clean', 0) + memory.get('private_dirty', 0), 1)
+    return memory
+
+
+def child_pids(pid):
+    """PIDs of the direct children of `pid` (e.g. the workers of a gunicorn master)."""
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return sorted(children)
+
+
+def worker_report(master_pid):
+    """[(pid, role, memory)] for the master and each of its workers."""
+    rows = [(master_pid, "master", process_memory(master_pid))]
+    rows += [(pid, "worker", process_memory(pid)) for pid in child_pids(master_pid)]
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shared vs. private memory per worker process.")
+    parser.add_argument("master_pid", type=int, help="PID of the gunicorn master")
+    args = parser.parse_args()
+
+    rows = worker_report(args.master_pid)
+    print(f"{'PID':>8} {'ROLE':<7} {'RSS MB':>9} {'PSS MB':>9} {'SHARED MB':>10} {'PRIVATE MB':>11}")
+    for pid, role, memory in rows:
+        print(f"{pid:>8} {role:<7} {memory.get('rss', 0):>9} {memory.get('pss', 0):>9} "
+              f"{memory.get('shared', 0):>10} {memory.get('private', 0):>11}")
+    total_pss = sum(memory.get('pss', 0) for _, _, memory in rows)
+    print(f"Total PSS (actual memory used by all processes): {round(total_pss, 1)} MB")
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from forest_artifacts import load_model
+from log_config import get_logger
+
+logger = get_logger("model_registry")
+
+# --- Configuration ---
+# Model artifacts live one level up from backend/. The folder is 'ML_MODELS' in the
+# repository, but older checkouts (and case-insensitive file systems) use 'ml_models'.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODEL_DIR_NAMES = ('ML_MODELS', 'ml_models')
+
+
+def resolve_model_path(*parts):
+    """
+    Resolves a path relative to the project's model folder, e.g.
+    resolve_model_path('Relief_Efficacy_Models', 'model_yoga.pkl').
+    Returns the first candidate that exists, else the path under 'ML_MODELS'.
+    """
+    candidates = [os.path.join(PROJECT_ROOT, dir_name, *parts) for dir_name in MODEL_DIR_NAMES]
+    return next((path for path in candidates if os.path.exists(path)), candidates[0])
+
+
+@contextmanager
+def ignore_feature_name_warning():
+    """
+    Silences sklearn's "X does not have valid feature names" warning for one predict
+    call whose input is a NumPy matrix already in the model's training column order.
+    Scoped to the call, so any other model that gets unnamed input still warns.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        yield
+
+
+class LazyResource:
+    """
+    A named service (planner, recommender, ...) built by `factory` on first use.
+    A failed build is remembered, so callers get None instead of retrying a slow load.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.state = "not_loaded"  # -> "loading" -> "resident" | "failed"
+        self.error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.state == "resident":
+            return self.value
+        with self._lock:
+            if self.state in ("resident", "failed"):
+                return self.value  # Built by another thread while we waited
+            self.state = "loading"
+            start = time.perf_counter()
+            try:
+                self.value = self.factory()
+                self.state = "resident"
+            except Exception as e:
+                logger.error("❌ Failed to initialize %s: %s", self.name, e)
+                self.error = str(e)
+                self.state = "failed"
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            return self.value
+
+    def status(self):
+        return {"state": self.state, "load_seconds": self.load_seconds, "error": self.error}
+
+
+class ModelRegistry:
+    """
+    Process-wide, load-once store of unpickled model artifacts.
+    Each artifact is loaded on first use and shared by every caller afterwards.
+    Loads of different artifacts can run in parallel; concurrent requests for the
+    same artifact wait for the single load in progress.
+    """
+    def __init__(self):
+        self._artifacts = {}   # absolute path -> loaded object
+        self._load_locks = {}  # absolute path -> lock held while that path is loading
+        self._lock = threading.Lock()
+        self._resources = {}   # name -> LazyResource, in registration order
+        self._warm_thread = None
+
+    def get(self, path, loader=load_model, reload=False):
+        """
+        Returns the artifact at `path`, loading it with `loader` the first time.
+        The default loader memory-maps a packed forest next to the .pkl when there is one.
+        """
+        path = os.path.abspath(path)
+        if not reload:
+            artifact = self._artifacts.get(path)
+            if artifact is not None:
+                return artifact
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(path, threading.Lock())
+        with load_lock:
+            if not reload and path in self._artifacts:
+                return self._artifacts[path]  # Loaded by another thread while we waited
+            artifact = loader(path)
+            self._artifacts[path] = artifact
+            logger.debug("📦 Loaded model artifact: %s", path)
+            return artifact
+
+    def load(self, *parts, reload=False):
+        """get() for a path relative to the model folder (see resolve_model_path)."""
+        return self.get(resolve_model_path(*parts), reload=reload)
+
+    def exists(self, *parts):
+        return os.path.exists(resolve_model_path(*parts))
+
+    def is_loaded(self, *parts):
+        return os.path.abspath(resolve_model_path(*parts)) in self._artifacts
+
+    def loaded_paths(self):
+        """Absolute paths of every resident artifact."""
+        return sorted(self._artifacts)
+
+    def evict(self, path=None):
+        """Drops one artifact (or all of them) so the next get() reloads from disk."""
+        with self._lock:
+            if path is None:
+                self._artifacts.clear()
+            else:
+                self._artifacts.pop(os.path.abspath(path), None)
+
+    # --- Lazy services ---
+
+    def register_resource(self, name, factory):
+        """Registers a service that is built by factory() the first time resource(name) is called."""
+        self._resources[name] = LazyResource(name, factory)
+        return self._resources[name]
+
+    def resource(self, name):
+        """Returns the named service, building it on first use (None if it failed to build)."""
+        return self._resources[name].get()
+
+    def warm(self, names=None):
+        """Builds the named services (all of them by default) in registration order."""
+        for name in names or list(self._resources):
+            self._resources[name].get()
+
+    def warm_in_background(self, names=None):
+        """Runs warm() on a daemon thread so the server can accept requests meanwhile."""
+        self._warm_thread = threading.Thread(target=self.warm, args=(names,), name="model-warmup", daemon=True)
+        self._warm_thread.start()
+        return self._warm_thread
+
+    def is_ready(self):
+        """True once no service is loading and no background warm-up is still running."""
+        if self._warm_thread is not None and self._warm_thread.is_alive():
+            return False
+        return all(res.state != "loading" for res in self._resources.values())
+
+    def resource_status(self):
+        """Per-service load state plus the file names of every resident artifact."""
+        return {
+            "models": {name: res.status() for name, res in self._resources.items()},
+            "artifacts": [os.path.relpath(path, PROJECT_ROOT) for path in self.loaded_paths()],
+        }
+
+
+# Shared by every service in the process
+registry = ModelRegistry()
@@ -1,16 +1,19 @@
-import joblib
-import os
-import pandas as pd
+import hashlib
+import json
+from collections import Counter
 import numpy as np
+from feature_encoder import RequestFeatureEncoder
+from model_registry import registry, ignore_feature_name_warning
+from result_cache import LRUCache
+from log_config import get_logger
+
+logger = get_logger("relief_recommender")
 
 # --- Configuration ---
-# Uses paths relative to this file's location (in ML_PIPELINE)
-# os.path.dirname(__file__) gets the current folder: 'backend'
-# os.path.join(..., '..', 'ml_models') goes up one level and into 'ml_models'
-ML_MODELS_DIR_ABSOLUTE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'ml_models'))
+# Paths are relative to the project's model folder; the shared model registry
+# resolves them and unpickles each artifact once per process.
 TOP_FEATURES_FILE = 'final_feature_names.pkl' 
 REMEDY_MODELS_SUBDIR = 'Relief_Efficacy_Models'
-REMEDY_MODELS_DIR = os.path.join(ML_MODELS_DIR_ABSOLUTE, REMEDY_MODELS_SUBDIR)
 MODEL_BASE_NAME = 'model_'
 
 # This list must match the remedies you trained
@@ -31,6 +34,10 @@ TARGET_COLUMNS = [
 
 SEVERITY_LABELS = {0: "Mild/None", 1: "Moderate", 2: "Severe"}
 
+# Full remedy rankings keyed by (user_id, model_version, profile fingerprint)
+RANKING_CACHE_SIZE = 4096
+RANKING_CACHE_TTL_SECONDS = 24 * 60 * 60
+
 # --- Expanded Recipe Database (Actionable Steps) ---
 # This is from your script, ready to be sent to the app
 RECIPES = {
@@ -107,33 +114,56 @@ class ReliefRecommender:
     a single recommendation function.
     """
     def __init__(self):
+        self.model_version = 0  # Bumped on every model reload; part of every ranking cache key
+        # Profiles change rarely, so the full remedy ranking is memoized per user
+        self.ranking_cache = LRUCache(max_size=RANKING_CACHE_SIZE, ttl_seconds=RANKING_CACHE_TTL_SECONDS)
+        self._load_models()
+
+    def _load_models(self, reload=False):
+        """Loads the base profile features and every available remedy model via the registry."""
         self.models = {}
         self.model_features = {}
         try:
             # Load the main feature list used for user profiles
-            self.profile_feature_names = joblib.load(os.path.join(ML_MODELS_DIR_ABSOLUTE, TOP_FEATURES_FILE))
-            print("✅ ReliefRecommender: Loaded base profile features.")
+            self.profile_feature_names = registry.load(TOP_FEATURES_FILE, reload=reload)
+            logger.info("✅ ReliefRecommender: Loaded base profile features.")
         except Exception as e:
-            print(f"❌ ReliefRecommender: CRITICAL ERROR loading base features: {e}")
+            logger.error("❌ ReliefRecommender: CRITICAL ERROR loading base features: %s", e)
             self.profile_feature_names = []
 
         # Load all individual remedy models
-        print("⏳ Loading individual relief models...")
+        logger.info("⏳ Loading individual relief models...")
         for remedy_name in TREATMENT_NAMES:
-            model_path = os.path.join(REMEDY_MODELS_DIR, f'{MODEL_BASE_NAME}{remedy_name}.pkl')
-            features_path = os.path.join(REMEDY_MODELS_DIR, f'features_{remedy_name}.pkl')
+            model_file = f'{MODEL_BASE_NAME}{remedy_name}.pkl'
+            features_file = f'features_{remedy_name}.pkl'
             
-            if os.path.exists(model_path) and os.path.exists(features_path):
+            if registry.exists(REMEDY_MODELS_SUBDIR, model_file) and registry.exists(REMEDY_MODELS_SUBDIR, features_file):
                 try:
-                    self.models[remedy_name] = joblib.load(model_path)
-                    self.model_features[remedy_name] = joblib.load(features_path)
-                    print(f"  > Loaded relief model: {remedy_name}")
+                    self.models[remedy_name] = registry.load(REMEDY_MODELS_SUBDIR, model_file, reload=reload)
+                    self.model_features[remedy_name] = registry.load(REMEDY_MODELS_SUBDIR, features_file, reload=reload)
+                    logger.info("  > Loaded relief model: %s", remedy_name)
                 except Exception as e:
                     # Inconsistent sklearn versions can cause this
-                    print(f"  > FAILED to load model {remedy_name}: {e}")
+                    logger.error("  > FAILED to load model %s: %s", remedy_name, e)
             else:
                 # This is not an error, some models might not exist yet
-                print(f"  > Skipping model (not found): {remedy_name}.pkl")
+                logger.info("  > Skipping model (not found): %s.pkl", remedy_name)
+
+        self._compile_remedy_layouts()
+
+    def reload_models(self):
+        """Reloads every remedy model from disk and drops every memoized ranking."""
+        self._load_models(reload=True)
+        self.model_version += 1
+        self.ranking_cache.invalidate()
+
+    def invalidate_user(self, user_id):
+        """Drops the memoized rankings of one user (called when their profile is rewritten)."""
+        return self.ranking_cache.invalidate(lambda key: key[0] == user_id)
+
+    def cache_stats(self):
+        """Hit-rate counters for the ranking cache."""
+        return {"rankings": self.ranking_cache.stats()}
 
     def get_remedy_instructions(self, remedy_name):
         """Fetches the recipe/steps for a given remedy ID."""
@@ -143,7 +173,163 @@ class ReliefRecommender:
             "steps": ["Instructions not yet available."]
         })
 
-    def recommend_relief(self, user_profile_data: dict, target_symptom: str, current_severity_ternary: int):
+    def _compile_remedy_layouts(self):
+        """
+        Precomputes, once at load time, where every remedy model's input columns live
+        in one shared profile vector and which column is its "what-if" indicator.
+        All remedies' inputs are then one gather from the encoded profile per request.
+        """
+        union_columns = []
+        for remedy_name in self.models:
+            for col in self.model_features[remedy_name]:
+                if col not in union_columns:
+                    union_columns.append(col)
+        self.profile_encoder = RequestFeatureEncoder(union_columns)
+
+        self._remedy_layouts = []  # (remedy_name, model, offset into the flat gather, width)
+        gather_positions = []
+        indicator_positions = []
+        for remedy_name, model in self.models.items():
+            remedy_feature_names = list(self.model_features[remedy_name])
+            # Find the remedy column name (e.g., 'remedy_turmericmilk' or 'ex_type_yoga')
+            indicator = next((i for i, col in enumerate(remedy_feature_names) if col.endswith(remedy_name)), None)
+            if indicator is None:
+                logger.info("  > Skipping %s: feature not in model list.", remedy_name)
+                continue
+
+            offset = len(gather_positions)
+            gather_positions.extend(self.profile_encoder.positions[col] for col in remedy_feature_names)
+            indicator_positions.append(offset + indicator)
+            self._remedy_layouts.append((remedy_name, model, offset, len(remedy_feature_names)))
+
+        self._gather_positions = np.array(gather_positions, dtype=np.intp)
+        self._indicator_positions = np.array(indicator_positions, dtype=np.intp)
+
+    def _build_remedy_inputs(self, user_profile_data):
+        """
+        Builds the what-if input row of every remedy in one pass: encode the profile once,
+        gather every remedy's columns into one flat array and switch on all indicators.
+        Returns [(remedy_name, model, 1 x n_features view)].
+        """
+        profile_row = self.profile_encoder.encode_mapping(user_profile_data)
+        flat_inputs = profile_row[self._gather_positions]
+        flat_inputs[self._indicator_positions] = 1  # Set each "what-if" feature to 1
+        return [(remedy_name, model, flat_inputs[offset:offset + width].reshape(1, -1))
+                for remedy_name, model, offset, width in self._remedy_layouts]
+
+    def _simulate_remedies(self, user_profile_data):
+        """
+        Predicts the full TARGET_COLUMNS severity row for every remedy.
+        Returns [(remedy_name, predictions_row)] in model load order; failing models are skipped.
+        """
+        simulations = []
+        for remedy_name, model, X_input in self._build_remedy_inputs(user_profile_data):
+            try:
+                # NumPy row already in the model's training column order
+                with ignore_feature_name_warning():
+                    simulations.append((remedy_name, model.predict(X_input)[0]))
+            except Exception as e:
+                logger.warning("  > ERROR predicting with %s: %s", remedy_name, e)
+        return simulations
+
+    @staticmethod
+    def _profile_fingerprint(user_profile_data):
+        """Stable hash of every profile value fed to the remedy models."""
+        canonical = json.dumps(user_profile_data, sort_keys=True, default=str)
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _ranked_remedies(self, user_profile_data, user_id=None):
+        """
+        _simulate_remedies() behind the ranking cache. The whole ranking (every remedy's
+        predicted severity for every symptom) is cached, so any target symptom is a hit.
+        Without a user_id nothing is cached, since there is no profile write to invalidate on.
+        """
+        if user_id is None:
+            return self._simulate_remedies(user_profile_data)
+
+        cache_key = (user_id, self.model_version, self._profile_fingerprint(user_profile_data))
+        simulations = self.ranking_cache.get(cache_key)
+        if simulations is None:
+            simulations = [(remedy_name, tuple(int(v) for v in predictions))
+                           for remedy_name, predictions in self._simulate_remedies(user_profile_data)]
+            if simulations:
+                self.ranking_cache.set(cache_key, simulations)
+        return simulations
+
+    @staticmethod
+    def _pick_best_remedy(simulations, symptom_index):
+        """Returns (remedy with the lowest predicted severity for one symptom, that severity)."""
+        best_remedy_id = None
+        min_predicted_severity = 3 # Start with worse than "Severe" (2)
+
+        for remedy_name, predictions in simulations:
+            predicted_severity = predictions[symptom_index]
+            logger.debug("  > SIM: %s -> %s", remedy_name, SEVERITY_LABELS.get(predicted_severity))
+
+            # 5. Check if this is the best outcome so far
+            if predicted_severity < min_predicted_severity:
+                min_predicted_severity = predicted_severity
+                best_remedy_id = remedy_name
+            # Tie-breaker: if severities are equal, pick the one with 'remedy' over 'ex_type' (simpler)
+            elif predicted_severity == min_predicted_severity and best_remedy_id and 'ex_type' in best_remedy_id:
+                 best_remedy_id = remedy_name
+        return best_remedy_id, min_predicted_severity
+
+    @staticmethod
+    def _symptom_label(symptom_key):
+        return symptom_key.replace('_ternary', '').replace('_', ' ').title()
+
+    def recommend_relief_all(self, user_profile_data: dict, user_id=None):
+        """
+        Ranks every remedy for every symptom from ONE set of model calls.
+        Returns the remedy x symptom predicted-severity matrix, the best remedy per symptom
+        and best_overall: the remedy that is best for the most symptoms (first one on a tie).
+        """
+        if not self.models:
+            return {"error": "No relief models are loaded."}
+
+        try:
+            simulations = self._ranked_remedies(user_profile_data, user_id)
+        except (TypeError, ValueError) as e:
+            return {"error": f"Invalid user profile data: {e}"}
+        if not simulations:
+            return {"error": "No suitable remedy recommendation could be generated."}
+
+        best_per_symptom = {}
+        for symptom_index, symptom_key in enumerate(TARGET_COLUMNS):
+            if any(len(predictions) <= symptom_index for _, predictions in simulations):
+                continue  # A model does not predict this symptom
+            best_remedy_id, min_predicted_severity = self._pick_best_remedy(simulations, symptom_index)
+            if best_remedy_id is None:
+                continue
+            best_per_symptom[symptom_key] = {
+                "target_symptom": self._symptom_label(symptom_key),
+                "best_remedy_id": best_remedy_id,
+                "best_remedy_name": self.get_remedy_instructions(best_remedy_id)['name'],
+                "predicted_severity": int(min_predicted_severity),
+                "predicted_outcome": SEVERITY_LABELS.get(min_predicted_severity, "N/A"),
+            }
+        if not best_per_symptom:
+            return {"error": "No suitable remedy recommendation could be generated."}
+
+        best_counts = Counter(best["best_remedy_id"] for best in best_per_symptom.values())
+        overall_remedy_id, symptom_count = best_counts.most_common(1)[0]
+        return {
+            "symptoms": TARGET_COLUMNS,
+            "remedies": [remedy_name for remedy_name, _ in simulations],
+            "severity_matrix": [[int(v) for v in predictions] for _, predictions in simulations],
+            "best_per_symptom": best_per_symptom,
+            "best_overall": {
+                "best_remedy_id": overall_remedy_id,
+                "best_remedy_name": self.get_remedy_instructions(overall_remedy_id)['name'],
+                "symptom_count": symptom_count,
+            },
+            "instructions": {remedy_name: self.get_remedy_instructions(remedy_name)
+                             for remedy_name in {best["best_remedy_id"] for best in best_per_symptom.values()}},
+        }
+
+    def recommend_relief(self, user_profile_data: dict, target_symptom: str, current_severity_ternary: int,
+                         user_id=None):
         """
         Runs the "what-if" simulation to find the best remedy.
         
@@ -151,78 +337,34 @@ class ReliefRecommender:
             user_profile_data (dict): The user's base profile from the 'user_profile' table.
             target_symptom (str): The symptom key, e.g., 'hot_flashes_severity_ternary'.
             current_severity_ternary (int): The user's current severity (0, 1, or 2).
+            user_id (str, optional): Enables the per-user ranking cache.
         """
         if not self.models:
             return {"error": "No relief models are loaded."}
-            
-        best_remedy_id = None
-        min_predicted_severity = 3 # Start with worse than "Severe" (2)
-        
-        # Convert the user_profile dictionary to a DataFrame for scikit-learn
-        user_df = pd.DataFrame([user_profile_data])
-
-        print(f"\n--- Running Relief Simulation for {target_symptom} ---")
 
-        for remedy_name, model in self.models.items():
-            remedy_feature_names = self.model_features[remedy_name]
-            
-            # 1. Align Input Data: Create an all-zero DataFrame with the model's expected columns
-            X_aligned = pd.DataFrame(0, index=[0], columns=remedy_feature_names)
-            
-            # 2. Fill in the user's profile data
-            for col in user_df.columns:
-                if col in X_aligned.columns:
-                    X_aligned.loc[0, col] = user_df.loc[0, col]
+        if target_symptom not in TARGET_COLUMNS:
+            return {"error": f"Target symptom '{target_symptom}' not found."}
+        # Find the index of the symptom we're targeting
+        symptom_index = TARGET_COLUMNS.index(target_symptom)
             
-            # 3. Simulate using this remedy
-            # Find the remedy column name (e.g., 'remedy_turmericmilk' or 'ex_type_yoga')
-            remedy_col_name = None
-            for col in remedy_feature_names:
-                if col.endswith(remedy_name):
-                    remedy_col_name = col
-                    break
-            
-            if remedy_col_name:
-                X_aligned.loc[0, remedy_col_name] = 1 # Set this "what-if" feature to 1
-            else:
-                print(f"  > Skipping {remedy_name}: feature not in model list.")
-                continue 
+        logger.debug("--- Running Relief Simulation for %s ---", target_symptom)
 
-            # 4. Predict Severity
-            try:
-                predictions = model.predict(X_aligned)
-            except Exception as e:
-                print(f"  > ERROR predicting with {remedy_name}: {e}")
-                continue
-
-            try:
-                # Find the index of the symptom we're targeting
-                symptom_index = TARGET_COLUMNS.index(target_symptom)
-                predicted_severity = predictions[0][symptom_index]
-                
-                print(f"  > SIM: {remedy_name} -> {SEVERITY_LABELS.get(predicted_severity)}")
-
-                # 5. Check if this is the best outcome so far
-                if predicted_severity < min_predicted_severity:
-                    min_predicted_severity = predicted_severity
-                    best_remedy_id = remedy_name
-                # Tie-breaker: if severities are equal, pick the one with 'remedy' over 'ex_type' (simpler)
-                elif predicted_severity == min_predicted_severity and best_remedy_id and 'ex_type' in best_remedy_id:
-                     best_remedy_id = remedy_name
-
-
-            except ValueError:
-                return {"error": f"Target symptom '{target_symptom}' not found."}
-            except Exception as e:
-                return {"error": f"Prediction failed for {remedy_name}: {str(e)}"}
+        try:
+            simulations = self._ranked_remedies(user_profile_data, user_id)
+        except (TypeError, ValueError) as e:
+            return {"error": f"Invalid user profile data: {e}"}
 
+        try:
+            best_remedy_id, min_predicted_severity = self._pick_best_remedy(simulations, symptom_index)
+        except Exception as e:
+            return {"error": f"Prediction failed: {str(e)}"}
 
         # 6. Final Output
         if best_remedy_id:
             remedy_details = self.get_remedy_instructions(best_remedy_id)
-            print(f"--- RECOMMENDED: {best_remedy_id} ---")
+            logger.debug("--- RECOMMENDED: %s ---", best_remedy_id)
             return {
-                "target_symptom": target_symptom.replace('_ternary', '').replace('_', ' ').title(),
+                "target_symptom": self._symptom_label(target_symptom),
                 "initial_severity": SEVERITY_LABELS.get(current_severity_ternary, "N/A"),
                 "best_remedy_id": best_remedy_id,
                 "best_remedy_name": remedy_details['name'],
@@ -230,5 +372,5 @@ class ReliefRecommender:
                 "instructions": remedy_details # Send the full instructions object
             }
         else:
-            print(f"--- NO RECOMMENDATION FOUND ---")
-            return {"error": "No suitable remedy recommendation could be generated."}
\ No newline at end of file
+            logger.debug("--- NO RECOMMENDATION FOUND ---")
+            return {"error": "No suitable remedy recommendation could be generated."}
@@ -0,0 +1,202 @@
+import argparse
+import threading
+import time
+import numpy as np
+from database import iter_symptom_log_chunks, update_predicted_stages, SYMPTOM_LOG_SLIDER_COLUMNS
+from model_registry import registry, resolve_model_path, ignore_feature_name_warning
+from log_config import get_logger
+
+logger = get_logger("stage_predictor")
+
+# --- Configuration ---
+STAGE_MODEL_FILE = 'stage_prediction_model.pkl'
+STAGE_FEATURES_FILE = 'stage_predictor_features.pkl'
+
+REQUIRED_FIELDS = ['hot_flashes', 'mood_swings', 'fatigue', 'sleep_issues', 'brain_fog']
+
+# App slider key -> model feature
+SYMPTOM_MAPPING = {
+    'hot_flashes': 'hot_flashes_severity_ternary',
+    'night_sweats': 'night_sweats_severity_ternary',
+    'mood_swings': 'mood_swings_severity_ternary',
+    'sleep_issues': 'sleep_disturbances_severity_ternary',
+    'fatigue': 'fatigue_severity_meno_ternary',
+    'brain_fog': 'brain_fog_severity_ternary',
+    'irritability': 'mood_swings_irritability_severity_ternary',
+}
+# Sliders that also fill a second feature (written after SYMPTOM_MAPPING, so they win)
+SHARED_SYMPTOM_FEATURES = {
+    'fatigue': ['fatigue_severity_meno_ternary', 'fatigue_severity_pcos_ternary'],
+    'mood_swings': ['mood_swings_severity_ternary', 'mood_swings_irritability_severity_ternary'],
+}
+
+STAGE_NAMES = {
+    0: "Premenopause",
+    1: "Perimenopause",
+    2: "Menopause",
+    3: "Postmenopause"
+}
+
+
+def convert_slider_to_ternary(value):
+    """Converts a 0-10 slider value to a 0-2 ternary scale."""
+    try:
+        val = int(value)
+        if val <= 3:  return 0  # Mild
+        elif val <= 7: return 1  # Moderate
+        else:          return 2  # Severe
+    except (ValueError, TypeError, OverflowError):
+        return 0 # Default to 0 if data is bad (OverflowError: +-inf)
+
+
+def convert_sliders_to_ternary(values):
+    """
+    Vectorized convert_slider_to_ternary for a whole column of slider values, with the
+    same results: numbers are truncated toward zero, then <=3 -> 0, <=7 -> 1, else 2.
+    Missing, non-finite or unparseable values -> 0.
+    """
+    column = np.asarray(values, dtype=object)
+    # Text goes through int() like the scalar version: astype(float) would accept "7.5"
+    has_text = any(isinstance(v, (str, bytes)) for v in column)
+    try:
+        numbers = None if has_text else column.astype(np.float64)  # None -> NaN
+    except (ValueError, TypeError):
+        numbers = None
+    if numbers is None:
+        return np.fromiter((convert_slider_to_ternary(v) for v in column), dtype=np.int64, count=len(column))
+    truncated = np.trunc(numbers)
+    ternary = np.where(truncated <= 3, 0, np.where(truncated <= 7, 1, 2))
+    ternary[~np.isfinite(truncated)] = 0  # NaN (missing) and +-inf
+    return ternary
+
+
+def map_stage_to_string(stage_code):
+    """Converts the model's number output to a user-friendly string."""
+    return STAGE_NAMES.get(stage_code, "Unknown")
+
+
+class StageInference:
+    """
+    Predicts the menopause stage from the app's 0-10 symptom sliders.
+    Slider -> feature positions are resolved once at load time, and each request
+    fills a preallocated per-thread row and runs ONE predict_proba pass, which
+    yields the stage, its confidence and the full class distribution.
+    """
+    def __init__(self, model_path=None, features_path=None):
+        self.model = registry.get(model_path or resolve_model_path(STAGE_MODEL_FILE))
+        self.feature_names = list(registry.get(features_path or resolve_model_path(STAGE_FEATURES_FILE)))
+        self.classes = list(self.model.classes_)
+        self.stage_names = [map_stage_to_string(code) for code in self.classes]
+
+        positions = {name: pos for pos, name in enumerate(self.feature_names)}
+        # (slider key, feature positions) in the order the values are written
+        self._slider_positions = [(app_key, [positions[model_key]] if model_key in positions else [])
+                                  for app_key, model_key in SYMPTOM_MAPPING.items()]
+        self._slider_positions += [(app_key, [positions[col] for col in cols if col in positions])
+                                   for app_key, cols in SHARED_SYMPTOM_FEATURES.items()]
+        self._local = threading.local()
+
+    def _row(self):
+        """This thread's reusable (1, n_features) input row."""
+        row = getattr(self._local, 'row', None)
+        if row is None:
+            row = self._local.row = np.zeros((1, len(self.feature_names)), dtype=np.float64)
+        return row
+
+    def encode(self, data, out=None):
+        """Writes the request's sliders (converted to ternary) into a zeroed feature row."""
+        row = self._row() if out is None else out
+        row.fill(0)
+        flat = row.reshape(-1)
+        for app_key, feature_positions in self._slider_positions:
+            if app_key in data:
+                flat[feature_positions] = convert_slider_to_ternary(data[app_key])
+        return row
+
+    def encode_columns(self, columns, n_rows):
+        """
+        Vectorized encode() for many rows at once: `columns` maps a slider key to an
+        array of raw slider values (keys that are absent count as 0, like a missing field).
+        """
+        matrix = np.zeros((n_rows, len(self.feature_names)), dtype=np.float64)
+        for app_key, feature_positions in self._slider_positions:
+            if app_key in columns and feature_positions:
+                matrix[:, feature_positions] = convert_sliders_to_ternary(columns[app_key])[:, None]
+        return matrix
+
+    def predict_batch(self, matrix):
+        """Stage names and confidences (%) for an encoded (n_rows, n_features) matrix."""
+        with ignore_feature_name_warning():  # Columns are in stage_model_features order
+            proba = np.asarray(self.model.predict_proba(matrix))
+        best = np.argmax(proba, axis=1)
+        stages = np.array(self.stage_names, dtype=object)[best]
+        confidence = np.round(proba[np.arange(len(best)), best] * 100, 2)
+        return stages, confidence
+
+    def predict(self, data):
+        """
+        Returns {"predicted_stage", "stage_code", "confidence", "probabilities"} for one request;
+        probabilities maps every stage the model knows to its percentage.
+        """
+        with ignore_feature_name_warning():
+            proba = self.model.predict_proba(self.encode(data))[0]
+        best = int(np.argmax(proba))
+        return {
+            "predicted_stage": self.stage_names[best],
+            "stage_code": int(self.classes[best]),
+            "confidence": round(float(proba[best]) * 100, 2),
+            "probabilities": {name: round(float(p) * 100, 2) for name, p in zip(self.stage_names, proba)},
+        }
+
+
+# --- Batch Re-scoring (symptom_logs backfill) ---
+
+def rescore_symptom_logs(stage_predictor=None, chunk_size=10000, dry_run=False, include_unscored=False):
+    """
+    Re-predicts predicted_stage in symptom_logs, e.g. after a new
+    stage_prediction_model.pkl ships. Logs are streamed in log_id chunks, each chunk
+    is encoded and scored in one batch, and the changed stages are written back in
+    one transaction per chunk.
+
+    Only rows that already hold a model stage (one of STAGE_NAMES) are re-scored;
+    rows written by /symptom-log keep their "Logged" marker unless include_unscored
+    is set. symptom_logs does not store night_sweats or irritability, so those
+    sliders count as 0 here and a backfilled stage can differ from the one
+    /predict-stage returned when the log was written.
+    Returns {"scanned", "changed", "updated", "seconds"}.
+    """
+    stage_predictor = stage_predictor or StageInference()
+    stats = {"scanned": 0, "changed": 0, "updated": 0}
+    start = time.perf_counter()
+    stage_filter = None if include_unscored else list(STAGE_NAMES.values())
+
+    for rows in iter_symptom_log_chunks(chunk_size, stages=stage_filter):
+        columns = {key: [row[key] for row in rows] for key in SYMPTOM_LOG_SLIDER_COLUMNS}
+        predicted, _ = stage_predictor.predict_batch(stage_predictor.encode_columns(columns, len(rows)))
+
+        stage_updates = [(stage, row['log_id']) for stage, row in zip(predicted, rows)
+                         if stage != row['predicted_stage']]
+        stats["scanned"] += len(rows)
+        stats["changed"] += len(stage_updates)
+        if stage_updates and not dry_run:
+            stats["updated"] += update_predicted_stages(stage_updates)
+        logger.info("  > Re-scored %d logs (%d changed so far)", stats["scanned"], stats["changed"])
+
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-score predicted_stage in symptom_logs.")
+    parser.add_argument("--model", help="stage model .pkl (default: ML_MODELS/stage_prediction_model.pkl)")
+    parser.add_argument("--features", help="feature list .pkl (default: ML_MODELS/stage_predictor_features.pkl)")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="logs scored and written per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="count changed stages without writing them")
+    parser.add_argument("--include-unscored", action="store_true",
+                        help="also score logs without a model stage (e.g. \"Logged\" from /symptom-log)")
+    args = parser.parse_args()
+
+    stats = rescore_symptom_logs(StageInference(args.model, args.features), args.chunk_size, args.dry_run,
+                                 args.include_unscored)
+    print(f"✅ Scanned {stats['scanned']} logs in {stats['seconds']}s: "
+          f"{stats['changed']} stage changes, {stats['updated']} rows updated.")
@@ -0,0 +1,155 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from log_config import get_logger
+
+logger = get_logger("write_behind")
+
+# --- Configuration (environment overrides) ---
+WRITE_QUEUE_SIZE = int(os.environ.get("MENOMAP_WRITE_QUEUE_SIZE", "10000"))
+WRITE_BATCH_ROWS = int(os.environ.get("MENOMAP_WRITE_BATCH_ROWS", "256"))
+WRITE_BATCH_MS = float(os.environ.get("MENOMAP_WRITE_BATCH_MS", "5"))
+# Longest a caller waits for its write to commit before giving up
+WRITE_TIMEOUT_SECONDS = float(os.environ.get("MENOMAP_WRITE_TIMEOUT", "30"))
+
+_FLUSH = object()  # Queue marker: commit everything queued before it
+
+
+class WriteBehindWriter:
+    """
+    One background thread that owns a database connection and applies queued
+    INSERT/UPDATE statements in group transactions. Everything queued while the
+    previous transaction was committing goes into the next one, capped at
+    `batch_rows` statements or `batch_ms` milliseconds of collecting.
+
+    submit() returns a Future resolved with the statement's lastrowid once its
+    batch has committed (or with the exception if it failed). The queue is bounded:
+    when it is full, submit() blocks, which slows producers down instead of
+    letting memory grow. close() (also run at interpreter exit) drains the queue.
+    If the writer thread fails (e.g. it cannot open the database), every queued
+    and later Future fails with that error instead of waiting forever.
+    """
+    def __init__(self, connect, max_queue=WRITE_QUEUE_SIZE, batch_rows=WRITE_BATCH_ROWS, batch_ms=WRITE_BATCH_MS):
+        self._connect = connect
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._error = None  # Set when the writer thread died; fails every later write
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def is_alive(self):
+        return not self._closed and self._error is None and self._thread.is_alive()
+
+    def _check_open(self):
+        if self._error is not None:
+            raise RuntimeError(f"WriteBehindWriter failed: {self._error}") from self._error
+        if not self.is_alive():
+            raise RuntimeError("WriteBehindWriter is closed")
+
+    def _enqueue(self, item):
+        self._check_open()
+        self._queue.put(item)  # Blocks while the queue is full (back-pressure)
+        if not self._thread.is_alive():
+            self._fail_pending()  # The thread died while we were queuing: nobody will drain this
+        return item[2]
+
+    def submit(self, sql, params=()) -> Future:
+        return self._enqueue((sql, params, Future()))
+
+    def flush(self, timeout=WRITE_TIMEOUT_SECONDS):
+        """Blocks until every statement submitted so far has been committed."""
+        self._enqueue((_FLUSH, None, Future())).result(timeout)
+
+    def close(self, timeout=30):
+        """Commits everything still queued, then stops the writer thread."""
+        if self._closed or not self._thread.is_alive():
+            return  # Already stopped, or a writer inherited across fork() whose thread never ran here
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    # --- Writer thread ---
+
+    def _next_batch(self):
+        """
+        Waits for one item, then takes whatever else is already queued, up to `batch_rows`
+        items or `batch_ms` after the first one. It never waits for more to arrive: rows
+        queued while the previous batch was committing form the next group.
+        """
+        first = self._queue.get()
+        batch = [first]
+        if first is None:
+            return batch
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_rows and time.monotonic() < deadline:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is None or item[0] is _FLUSH:
+                break
+        return batch
+
+    def _run(self):
+        conn, batch = None, []
+        try:
+            conn = self._connect()
+            while True:
+                batch = self._next_batch()
+                stop = batch[-1] is None
+                statements = [item for item in batch if item is not None and item[0] is not _FLUSH]
+                if statements:
+                    self._commit(conn, statements)
+                for item in batch:
+                    if item is not None and item[0] is _FLUSH:
+                        item[2].set_result(None)
+                if stop:
+                    return
+        except Exception as e:
+            logger.exception("❌ Write-behind writer stopped: %s", e)
+            self._error = e
+            for item in batch:
+                if item is not None and not item[2].done():
+                    item[2].set_exception(e)
+        finally:
+            self._fail_pending()  # Anything queued after close() or the failure
+            if conn is not None:
+                conn.close()
+
+    def _fail_pending(self):
+        """Fails every Future still queued (the writer thread is gone)."""
+        error = self._error or RuntimeError("WriteBehindWriter is closed")
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and not item[2].done():
+                item[2].set_exception(error)
+
+    def _commit(self, conn, statements):
+        """Runs a batch in one transaction; if it fails, retries statement by statement."""
+        try:
+            with conn:
+                row_ids = [conn.execute(sql, params).lastrowid for sql, params, _ in statements]
+        except Exception as e:
+            logger.warning("⚠️ Group commit of %d statements failed (%s); retrying one by one.", len(statements), e)
+            for sql, params, future in statements:
+                try:
+                    with conn:
+                        future.set_result(conn.execute(sql, params).lastrowid)
+                except Exception as row_error:
+                    future.set_exception(row_error)
+            return
+        for (_, _, future), row_id in zip(statements, row_ids):
+            future.set_result(row_id)
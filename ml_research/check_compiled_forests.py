@@ -0,0 +1,91 @@
+"""
+Parity and latency check: compiled forests (backend/forest_artifacts.py) vs. sklearn.
+
+For every forest .pkl in ML_MODELS, compares predict() and predict_proba() of the
+sklearn model with the in-memory compiled forest and, when it has been exported,
+the memory-mapped .forest artifact. Outputs must be bit-identical.
+
+    python ml_research/check_compiled_forests.py [--rows 2000]
+
+Exits with status 1 on any mismatch.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+import joblib
+import numpy as np
+
+warnings.filterwarnings("ignore")
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, "backend"))
+from forest_artifacts import artifact_dir_for, compile_forest, load_forest  # noqa: E402
+
+ML_MODELS_DIR = os.path.join(PROJECT_ROOT, "ML_MODELS")
+
+
+def random_inputs(n_features, n_rows, seed=0):
+    """Integer-coded rows like the app's encoded features, plus fractional values and NaNs."""
+    rng = np.random.default_rng(seed)
+    X = rng.integers(-1, 12, size=(n_rows, n_features)).astype(np.float64)
+    X[: n_rows // 4] = rng.random((n_rows // 4, n_features)) * 10
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return X
+
+
+def same_output(a, b):
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_output(x, y) for x, y in zip(a, b))
+    return a.dtype == b.dtype and np.array_equal(a, b)
+
+
+def mean_latency_ms(predict, X, repeats=20):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict(X)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def check_model(model_path, n_rows):
+    model = joblib.load(model_path)
+    try:
+        compiled = compile_forest(model)
+    except TypeError:
+        return None  # Not a forest
+    candidates = {"compiled": compiled}
+    if os.path.isdir(artifact_dir_for(model_path)):
+        candidates["packed"] = load_forest(artifact_dir_for(model_path))
+
+    X = random_inputs(compiled.n_features_in_, n_rows)
+    ok = True
+    for name, candidate in candidates.items():
+        ok &= same_output(model.predict(X), candidate.predict(X))
+        if hasattr(model, "predict_proba"):
+            ok &= same_output(model.predict_proba(X), candidate.predict_proba(X))
+
+    single_row = X[:1]
+    sk_ms = mean_latency_ms(model.predict, single_row)
+    compiled_ms = mean_latency_ms(compiled.predict, single_row)
+    print(f"{'OK ' if ok else 'FAIL'} {os.path.relpath(model_path, ML_MODELS_DIR):<50} "
+          f"checked: {', '.join(candidates):<16} 1-row predict: sklearn {sk_ms:7.2f} ms, "
+          f"compiled {compiled_ms:6.2f} ms ({sk_ms / compiled_ms:5.1f}x)")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000, help="random rows compared per model")
+    args = parser.parse_args()
+
+    results = []
+    for root, _, files in os.walk(ML_MODELS_DIR):
+        for name in sorted(files):
+            if name.endswith(".pkl"):
+                result = check_model(os.path.join(root, name), args.rows)
+                if result is not None:
+                    results.append(result)
+
+    print(f"\n{sum(results)}/{len(results)} forests match sklearn exactly.")
+    sys.exit(0 if all(results) else 1)